@@ -15,19 +15,106 @@ import traceback
 import inspect
 import socket
 import optparse
+import copy
+import time
+import shutil
+import fcntl
+import hashlib
+import zlib
+import shlex
+import re
+import random
+import threading
+import asyncio
+from contextvars import ContextVar, copy_context
+from functools import lru_cache
+from array import array
+from stat import S_ISREG, S_ISDIR, S_ISLNK
 from datetime import datetime
 from subprocess import Popen, PIPE, STDOUT
-from collections import OrderedDict
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 VERSION = '2.0.0'
-COLORS = True
-ANSWER_YES = False
 PYSYNC = f'{os.environ["HOME"]}/.pysync'
 SETTINGS = f'{PYSYNC}/pysync.json'
 try:
     PROG = os.path.basename(__file__)
 except Exception:
     PROG = 'pysync.py'
+# (compress, decompress) commands used when seeding a fresh entry with tar
+SEED_COMPRESSORS = OrderedDict([
+    ('gzip', ('gzip -c', 'gzip -dc')),
+    ('zstd', ('zstd -c -T0', 'zstd -dc')),
+    ('lz4', ('lz4 -c', 'lz4 -dc')),
+])
+# Extensions of files which are already compressed
+SKIP_COMPRESS = [
+    '7z', 'avi', 'bz2', 'flac', 'gif', 'gz', 'heic', 'jpeg', 'jpg', 'lz4',
+    'mkv', 'mov', 'mp3', 'mp4', 'ogg', 'pdf', 'png', 'rar', 'webm', 'webp',
+    'xz', 'zip', 'zst',
+]
+TRANSFER_PROFILES = {
+    'lan': {'compress': False, 'whole_file': True},
+    'wan': {'compress': True, 'skip_compress': SKIP_COMPRESS},
+    'media': {'compress': False, 'inplace': True},
+}
+DEFAULT_PROFILE = 'wan'
+# Measured rates (bytes/sec) and compression ratios used by the auto profile
+AUTO_LAN_RATE = 30 * 1024 * 1024
+AUTO_INCOMPRESSIBLE = 0.9
+HISTORY_SIZE = 50
+RSYNC_LOG_FORMAT = '%i<>%n<>%M<>%l<>%b'
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+# Threads used by the native engine for local to local pairs
+COPY_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# rsync keeps interrupted files here so a retry resumes them
+PARTIAL_DIR = '.rsync-partial'
+# Profiles with `inplace` only write files of at least this size in place
+INPLACE_MIN_SIZE = '64M'
+# Seconds without data before rsync gives up, and retries with backoff
+RSYNC_TIMEOUT = 300
+RSYNC_RETRIES = 5
+RSYNC_BACKOFF = 5
+RSYNC_VANISHED = 24
+RSYNC_RETRY_CODES = {
+    10: 'error in socket I/O',
+    11: 'error in file I/O',
+    12: 'error in rsync protocol data stream',
+    23: 'partial transfer due to error',
+    30: 'timeout in data send/receive',
+    35: 'timeout waiting for daemon connection',
+    255: 'ssh connection failure',
+}
+# Usually permanent (permission denied, disk full): retried only once
+RSYNC_RETRY_ONCE = {11, 23}
+PLAN_LARGEST = 10
+IGNORE_FILE = '.pysyncignore'
+# Journals older than this are discarded instead of resumed
+JOURNAL_MAX_AGE = 24 * 3600
+DELETE_WORKERS = min(16, (os.cpu_count() or 1) * 2)
+# Threads and entries of the per-entry content hash cache
+HASH_WORKERS = os.cpu_count() or 1
+HASH_CACHE_SIZE = 200000
+HASH_BLOCK = 1 << 20
+# Threads looking up local paths; they mostly wait on the filesystem (NFS)
+STAT_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# Directories with this many looked up entries are listed instead
+SCANDIR_MIN = 8
+# Output lines kept to report a failed streamed command, and the longest
+# line read from an asynchronous one
+STREAM_TAIL = 50
+STREAM_LINE_LIMIT = 1 << 20
+# Scheduler: runs are delayed by up to this fraction of the interval, failing
+# entries wait twice as long after each failure up to the maximum backoff
+SCHEDULE_JITTER = 0.1
+SCHEDULE_MAX_BACKOFF = 24 * 3600
+SCHEDULE_TICK = 5
+MAX_SYNCS = 4
+INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+# ioctl request to clone a file (reflink) on btrfs/xfs: linux/fs.h
+FICLONE = 0x40049409
 
 
 class BreakIteration(Exception):
@@ -110,6 +197,15 @@ class Right(Either):
         Either.__init__(self, True, val)
 
 
+def sequence(eithers):
+    values = []
+    for either in eithers:
+        if not either.right:
+            return either
+        values.append(either.value)
+    return Right(values)
+
+
 def eval_iteration(comp):
     try:
         return Right(comp()[0])
@@ -152,6 +248,26 @@ def write_text(text, filename):
         ))
 
 
+def replace_text(text, filename):
+    # Readers see the old or the new contents, never a partial file
+    tmp = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp, 'w') as fpointer:
+            fpointer.write(text)
+            fpointer.flush()
+            os.fsync(fpointer.fileno())
+        os.replace(tmp, filename)
+        return Right(True)
+    except Exception as ex:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        return Left(Issue(
+            message='failed to write to file',
+            data={'filename': filename},
+            cause=ex,
+        ))
+
+
 def write_json(data, filename):
     return eval_iteration(lambda: [
         True
@@ -160,8 +276,64 @@ def write_json(data, filename):
     ])
 
 
+class Options:
+    """
+    Settings of the running sync. The command line sets them once in `main`;
+    every `SyncEngine` call runs with its own copy.
+    """
+    def __init__(self, colors=True, answer_yes=False, seed_compressor=None,
+                 max_transfers=None, status_file=None, on_event=None):
+        self.colors = colors
+        self.answer_yes = answer_yes
+        self.seed_compressor = seed_compressor
+        self.max_transfers = max_transfers
+        # Status messages go to stderr when stdout is used for the plan
+        self.status_file = status_file
+        # Receives an Event instead of printing it
+        self.on_event = on_event
+
+
+OPTIONS = ContextVar('pysync_options', default=Options())
+
+
+class Event:
+    def __init__(self, kind, message, data):
+        self.kind = kind
+        self.message = message
+        self.data = data
+
+    def to_dict(self):
+        return OrderedDict([
+            ('kind', self.kind),
+            ('message', self.message),
+            ('data', self.data),
+        ])
+
+
+def render(event):
+    data = event.data
+    if event.kind == 'status':
+        return f'{cstr(C.bd_blue, "STATUS:")} {cstr(C.blue, event.message)}'
+    if event.kind == 'warning':
+        return f'{cstr(C.bd_yellow, "warning:")} {event.message}'
+    if event.kind == 'info':
+        color = data.get('color')
+        txt = cstr(color, event.message) if color else event.message
+        return f'{data["index"]} {cstr(C.cyan, data["path"])} {txt}'
+    return event.message
+
+
+def emit(kind, message, **data):
+    options = OPTIONS.get()
+    event = Event(kind, message, data)
+    if options.on_event:
+        options.on_event(event)
+    else:
+        print(render(event), file=options.status_file if kind == 'status' else None)
+
+
 def cstr(color, msg):
-    return f'{color}{msg}\033[0m' if COLORS else msg
+    return f'{color}{msg}\033[0m' if OPTIONS.get().colors else msg
 
 
 class C:
@@ -188,20 +360,31 @@ def error(msg, issue=None):
     return 1
 
 def warning(msg):
-    print(f'{cstr(C.bd_yellow, "warning:")} {msg}')
+    emit('warning', msg)
 
 
 class Pair:
-    def __init__(self, name, local, remote, date_created=None, last_synced=None):
+    def __init__(self, name, local, remote, date_created=None, last_synced=None, **kwargs):
         self.name = name
         self.local = local
         self.remote = remote
         self.date_created = date_created or int(datetime.timestamp(datetime.now()))
         self.id = hex(self.date_created)
         self.date_synced = last_synced or None
+        self.resources = kwargs.get('resources') or {}
+        self.profile = kwargs.get('profile')
+        self.replicas = kwargs.get('replicas') or []
+        self.verify = bool(kwargs.get('verify'))
+        self.interval = kwargs.get('interval')
+        # Index of the remote a replica view of a fan-out entry works with
+        self.replica = 0
+
+    @property
+    def remotes(self):
+        return [self.remote] + self.replicas
 
     def to_dict(self):
-        return {
+        obj = {
             'id': self.id,
             'name': self.name,
             'local': self.local,
@@ -209,13 +392,24 @@ class Pair:
             'date_created': self.date_created,
             'date_synced': self.date_synced,
         }
+        if self.resources:
+            obj['resources'] = self.resources
+        if self.profile:
+            obj['profile'] = self.profile
+        if self.replicas:
+            obj['replicas'] = self.replicas
+        if self.verify:
+            obj['verify'] = True
+        if self.interval:
+            obj['interval'] = self.interval
+        return obj
 
     def __str__(self):
         lbr = cstr(C.bold, '[')
         rbr = cstr(C.bold, ']')
         name = cstr(C.green, self.name)
         local = cstr(C.cyan, self.local)
-        remote = cstr(C.magenta, self.remote)
+        remote = ', '.join(cstr(C.magenta, x) for x in self.remotes)
         sync_date = cstr(C.gray, '     Never Synced     ')
         if self.date_synced:
             date_fmt = '%b/%d/%Y - %H:%M:%S'
@@ -230,39 +424,94 @@ class Pair:
         ])
 
 
-def create_pair(local, remote, name):
-    if not os.path.isdir(local):
-        return Left(Issue(
-            message='local directory does not exist',
-            data={'local': local},
-        ))
-    local = os.path.abspath(local)
-    if local[-1] != '/':
-        local += '/'
+def pair_from_dict(data):
+    return Pair(
+        data['name'],
+        data['local'],
+        data['remote'],
+        data['date_created'],
+        data['date_synced'],
+        resources=data.get('resources'),
+        profile=data.get('profile'),
+        replicas=data.get('replicas'),
+        verify=data.get('verify'),
+        interval=data.get('interval'),
+    )
 
-    if os.path.isdir(remote):
-        remote = os.path.abspath(remote)
-    else:
+
+def create_pairs(entries, specs):
+    # specs are (local, remote, name) tuples. The remote directories are
+    # checked with one ssh call per host and every pair gets its own id,
+    # even when registered within the same second.
+    names = [name for _, _, name in specs]
+    for name in names:
+        if names.count(name) > 1 or any(x.name == name for x in entries):
+            return Left(Issue(f'{name} already registered'))
+    roots = []
+    for local, _, _ in specs:
+        if not os.path.isdir(local):
+            return Left(Issue(
+                message='local directory does not exist',
+                data={'local': local},
+            ))
+        local = os.path.abspath(local)
+        roots.append(local if local[-1] == '/' else f'{local}/')
+    created = max(
+        [int(datetime.timestamp(datetime.now()))] +
+        [x.date_created + 1 for x in entries]
+    )
+    return eval_iteration(lambda: [
+        pairs
+        for remote_dirs in check_remotes([remote for _, remote, _ in specs])
+        for pairs in [[
+            Pair(name, local, remote_dir, created + i)
+            for i, (local, remote_dir, name) in enumerate(zip(roots, remote_dirs, names))
+        ]]
+        for _ in [os.makedirs(PYSYNC, exist_ok=True)]
+        for _ in [[open(f'{PYSYNC}/{pair.id}.txt', 'w').close() for pair in pairs]]
+    ])
+
+
+def check_remote(remote):
+    return check_remotes([remote]).flat_map(lambda remotes: Right(remotes[0]))
+
+
+def check_remotes(remotes):
+    # The directories of each host are checked with a single ssh call
+    checked = {}
+    batches = {}
+    for remote in remotes:
+        if os.path.isdir(remote):
+            checked[remote] = os.path.abspath(remote)
+            continue
         tmp = remote.split(':')
         if len(tmp) == 1:
             return Left(Issue(
                 message='non-local remote directories are of the form hostname:dir',
                 data={'remote': remote},
             ))
-        exit_code = os.system("ssh %s 'cd %s'" % (tmp[0], tmp[1]))
-        if exit_code != 0:
+        batch = batches.setdefault(tmp[0], RemoteBatch(tmp[0]))
+        checked[remote] = (batch, batch.isdir(tmp[1]))
+    for host, batch in batches.items():
+        result = batch.run()
+        if not result.right:
             return Left(Issue(
                 message='verify hostname and remote directory',
-                data={
-                    'remote': remote,
-                    'ssh_exit_code': exit_code,
-                },
+                data={'host': host, 'output': result.value.data['output']},
             ))
-    if remote[-1] != '/':
-        remote += '/'
-    pair = Pair(name, local, remote)
-    open(f'{PYSYNC}/{pair.id}.txt', 'w').close()
-    return Right(pair)
+    for remote, value in checked.items():
+        if isinstance(value, tuple):
+            batch, index = value
+            if not batch.results[index]:
+                return Left(Issue(
+                    message='verify hostname and remote directory',
+                    data={'remote': remote},
+                ))
+            checked[remote] = remote
+    return Right([
+        checked[remote] if checked[remote].endswith('/') else f'{checked[remote]}/'
+        for remote in remotes
+    ])
 
 
 def entry_str(index, entry):
@@ -299,7 +548,7 @@ def get_entry(entries, name):
 
 
 def should_proceed(prompt):
-    if ANSWER_YES:
+    if OPTIONS.get().answer_yes:
         return Right(True)
     print(prompt)
     choice = input(cstr(C.bold, '[yes/no] => ')).lower()
@@ -310,9 +559,82 @@ def should_proceed(prompt):
     return Left(Issue("Please respond with 'yes' or 'no'"))
 
 
+def load_entries():
+    if not os.path.isfile(SETTINGS):
+        return Right([])
+    return read_json(SETTINGS).flat_map(
+        lambda data: Right([pair_from_dict(x) for x in data]))
+
+
+def modify_entries(fct):
+    # pysync.json is read again under a lock shared by every pysync process
+    # so that the entries other processes changed since it was loaded are kept
+    os.makedirs(PYSYNC, exist_ok=True)
+    with file_lock(f'{PYSYNC}/pysync.lock'):
+        return eval_iteration(lambda: [
+            True
+            for entries in load_entries()
+            for _ in fct(entries)
+            for text in to_json([x.to_dict() for x in entries])
+            for _ in replace_text(text, SETTINGS)
+        ])
+
+
+def update_entry(entry, **fields):
+    # Only the given fields of the stored entry are written
+    for key, value in fields.items():
+        setattr(entry, key, value)
+
+    def update(entries):
+        stored = next((x for x in entries if x.id == entry.id), None)
+        if stored is None:
+            return Left(Issue(f'{entry.name} is no longer registered'))
+        for key, value in fields.items():
+            setattr(stored, key, value)
+        return Right(True)
+    return modify_entries(update)
+
+
+def add_entries(entries, new_entries):
+    def add(stored):
+        for new_entry in new_entries:
+            if any(x.name == new_entry.name or x.id == new_entry.id for x in stored):
+                return Left(Issue(f'{new_entry.name} already registered'))
+        stored.extend(new_entries)
+        return Right(True)
+    return modify_entries(add).flat_map(lambda _: Right(entries.extend(new_entries)))
+
+
 def remove_entry(entries, index):
-    del entries[index]
-    return write_json([x.to_dict() for x in entries], SETTINGS)
+    entry = entries.pop(index)
+
+    def remove(stored):
+        stored[:] = [x for x in stored if x.id != entry.id]
+        return Right(True)
+    return modify_entries(remove)
+
+
+def data_dir(entry):
+    path = f'{PYSYNC}/{entry.id}'
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def entry_dir(entry):
+    if not entry.replica:
+        return data_dir(entry)
+    path = f'{data_dir(entry)}/replica-{entry.replica}'
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def replica_view(entry, index, remote=None):
+    # Shares the local directory, snapshot and sync date of the entry
+    view = copy.copy(entry)
+    view.remote = remote or entry.remotes[index]
+    view.replicas = []
+    view.replica = index + 1
+    return view
 
 
 def remove_entry_data(entry):
@@ -323,21 +645,26 @@ def remove_entry_data(entry):
         pass
     except Exception:
         warning(f'Unable to remove {data}. This may need to be done manually.')
+    data = f'{os.environ["HOME"]}/.pysync/{entry.id}'
+    try:
+        shutil.rmtree(data)
+    except FileNotFoundError:
+        pass
+    except Exception:
+        warning(f'Unable to remove {data}. This may need to be done manually.')
     return Right(True)
 
 
 def reset_entry(entries, index):
-    entries[index].date_synced = None
-    return write_json([x.to_dict() for x in entries], SETTINGS)
+    return update_entry(entries[index], date_synced=None)
 
 
 def update_entry_name(entries, index, name):
-    entries[index].name = name
-    return write_json([x.to_dict() for x in entries], SETTINGS)
+    return update_entry(entries[index], name=name)
 
 
 def print_status(status):
-    print(f'{cstr(C.bd_blue, "STATUS:")} {cstr(C.blue, status)}')
+    emit('status', status)
 
 
 def eval_cmd(cmd):
@@ -358,268 +685,2789 @@ def eval_cmd(cmd):
     ))
 
 
-def parse_incoming_output(out):
-    temp_files = out.split('\n')[1:-3]
-    incoming = []
-    remote_missing = []
-    for line in temp_files:
-        items = line.split('<>')
-        if len(items) > 1:
-            fname, time = items
-            incoming.append((fname, datetime.strptime(time, '%Y/%m/%d-%H:%M:%S')))
-        else:
-            action = line.split(' ', 1)
-            if len(action) > 1:
-                remote_missing.append(action[1])
-    return Right((incoming, remote_missing))
-
-
-def fetch_incoming(entry):
-    print_status('Receiving list of incoming files...')
-    cmd = ' '.join(['rsync',
-        '-navz',
-        '--delete',
-        '--exclude .DS_Store',
-        '--out-format="%n<>%M"',
-        f'{entry.remote} {entry.local}'
-    ])
-    return eval_iteration(lambda: [
-        (incoming, remote_missing)
-        for out in eval_cmd(cmd)
-        for incoming, remote_missing in parse_incoming_output(out)
-    ])
+def stream_cmd(cmd, feed):
+    # Each line of output is handed to feed as it is read, only a short
+    # tail is kept to report a failure
+    process = Popen(
+        cmd,
+        shell=True,
+        universal_newlines=True,
+        errors='surrogateescape',
+        executable="/bin/bash",
+        stdout=PIPE,
+        stderr=STDOUT
+    )
+    tail = deque(maxlen=STREAM_TAIL)
+    for line in process.stdout:
+        line = line.rstrip('\n')
+        tail.append(line)
+        feed(line)
+    return stream_result(cmd, process.wait(), tail)
 
 
-def print_info(index, fpath, msg, color=None):
-    txt = cstr(color, msg) if color else msg
-    print(f'{index} {cstr(C.cyan, fpath)} {txt}')
+async def async_stream_cmd(cmd, feed):
+    process = await asyncio.create_subprocess_exec(
+        '/bin/bash', '-c', cmd,
+        stdout=PIPE,
+        stderr=STDOUT,
+        limit=STREAM_LINE_LIMIT
+    )
+    tail = deque(maxlen=STREAM_TAIL)
+    async for line in process.stdout:
+        line = line.decode('utf-8', 'surrogateescape').rstrip('\n')
+        tail.append(line)
+        feed(line)
+    return stream_result(cmd, await process.wait(), tail)
 
 
-def print_msg(msg):
-    print(msg)
-    return Right(0)
+def stream_result(cmd, returncode, tail):
+    if returncode == 0:
+        return Right(True)
+    return Left(Issue(
+        message='command returned a non zero exit code',
+        data={'cmd': cmd, 'output': '\n'.join(tail)}
+    ))
 
 
-def write_exclusions(entry, incoming):
-    if incoming:
-        print_status(f'Analysing {len(incoming)} incoming files to avoid erroneous overwriting...')
-    exclude_list = []
-    total = cstr(C.blue, len(incoming))
-    date_synced = datetime(1,1,1)
-    if entry.date_synced:
-        date_synced = datetime.fromtimestamp(entry.date_synced)
-    for index, in_file in enumerate(incoming):
-        fname = in_file[0]
-        num = f'[{index+1}/{total}]:'
-        file_path = f'{entry.local}{fname}'
-        if os.path.isfile(file_path):
-            local_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-            if local_time > date_synced:
-                if in_file[1] > date_synced:
-                    (dir_name, file_name) = os.path.split(fname)
-                    host = socket.gethostname()
-                    time = local_time.strftime("%Y_%m_%d-%H_%M_%S")
-                    new_name = f'{dir_name}/{file_name}-{host}-{time}'
-                    os.rename(file_path, f'{entry.local}{new_name}')
-                    print_info(num, fname, f'renamed to {new_name}', C.yellow)
-                else:
-                    print_info(num, fname, 'has been modified locally', C.red)
-            else:
-                print_info(num, fname, 'has not been modified')
-        elif os.path.isdir(file_path):
-            print_info(num, fname, 'is an existing directory')
-        else:
-            print_info(num, fname, 'may be excluded', C.yellow)
-            exclude_list.append(fname)
-    with open(f'{PYSYNC}/potential_exclusions.txt', 'w') as fpointer:
-        fpointer.write('\n'.join(exclude_list))
+async def in_thread(fct, *args):
+    # Blocking work awaited from a coroutine, reporting like the caller
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, copy_context().run, fct, *args)
 
-    # To find lines common to two files
-    # http://www.unix.com/shell-programming-scripting/144741-simple-script-find-common-strings-two-files.html
-    command = f'grep -Fxf {PYSYNC}/potential_exclusions.txt {PYSYNC}/{entry.id}.txt > {PYSYNC}/exclude.txt'  # pylint: disable=line-too-long
-    os.system(command)
-    return Right(True)
 
+def run_together(*coroutines):
+    async def run():
+        return await asyncio.gather(*coroutines)
+    return asyncio.run(run())
 
-def write_removals(entry, remote_missing):
-    if remote_missing:
-        print_status(f'Analysing {len(remote_missing)} local files to avoid erroneous removal...')
-    removal_list = []
-    total = cstr(C.blue, len(remote_missing))
-    date_synced = datetime(1,1,1)
-    if entry.date_synced:
-        date_synced = datetime.fromtimestamp(entry.date_synced)
-    for index, fname in enumerate(remote_missing):
-        num = f'[{index+1}/{total}]:'
-        file_path = f'{entry.local}{fname}'
-        if os.path.isfile(file_path):
-            local_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-            if local_time > date_synced:
-                print_info(num, fname, 'has been modified - will stay')
-            else:
-                print_info(num, fname, ' may require deletion', C.yellow)
-                removal_list.append(fname)
-        else:
-            print_info(num, fname, 'may require directory deletion', C.yellow)
-            removal_list.append(fname)
-    with open(f'{PYSYNC}/potential_removals.txt', 'w') as fpointer:
-        fpointer.write('\n'.join(removal_list))
 
-    command = f'grep -Fxf {PYSYNC}/potential_removals.txt {PYSYNC}/{entry.id}.txt > {PYSYNC}/remove.txt'  # pylint: disable=line-too-long
-    os.system(command)
-    return Right(True)
+def pipe_cmd(cmd, data, ok_codes=(0,)):
+    process = Popen(
+        cmd,
+        shell=True,
+        executable="/bin/bash",
+        stdin=PIPE,
+        stdout=PIPE,
+        stderr=PIPE
+    )
+    out, err = process.communicate(data.encode('utf-8', 'surrogateescape'))
+    if process.returncode in ok_codes:
+        return Right(out.decode('utf-8', 'surrogateescape'))
+    return Left(Issue(
+        message='command returned a non zero exit code',
+        data={'cmd': cmd, 'output': err.decode('utf-8', 'replace')}
+    ))
 
 
-def sync_remote_to_local(entry):
-    print_status('Calling rsync: REMOTE to LOCAL (UPDATE/NO DELETION)')
-    cmd = ' '.join(['rsync',
-        '-razuv',
-        '--progress',
-        f'--exclude-from {PYSYNC}/exclude.txt',
-        f'{entry.remote} {entry.local}'
-    ])
-    exit_code = os.system(cmd)
-    if exit_code != 0:
+def run_cmd(cmd):
+    if not OPTIONS.get().on_event:
+        return Popen(cmd, shell=True, executable='/bin/bash').wait()
+    process = Popen(
+        cmd,
+        shell=True,
+        universal_newlines=True,
+        errors='surrogateescape',
+        executable='/bin/bash',
+        stdout=PIPE,
+        stderr=STDOUT
+    )
+    for line in process.stdout:
+        emit('output', line.rstrip('\n'))
+    return process.wait()
+
+
+def priorities(entry):
+    # (nice, ionice class, ionice level) of an entry, None when not set.
+    # Raises ValueError for invalid settings.
+    policy = entry.resources
+    nice = io_class = level = None
+    if policy.get('nice') is not None:
+        nice = int(policy['nice'])
+        if not -20 <= nice <= 19:
+            raise ValueError('nice must be between -20 and 19')
+    ionice = policy.get('ionice')
+    if ionice is not None:
+        if not isinstance(ionice, dict):
+            ionice = {'class': ionice}
+        io_class = IONICE_CLASSES.get(ionice.get('class'), ionice.get('class'))
+        if io_class not in IONICE_CLASSES.values():
+            raise ValueError(f'ionice class must be one of {", ".join(IONICE_CLASSES)}')
+        if ionice.get('level') is not None:
+            level = int(ionice['level'])
+            if not 0 <= level <= 7:
+                raise ValueError('ionice level must be between 0 and 7')
+    return nice, io_class, level
+
+
+def check_settings(entry):
+    # Settings edited by hand in pysync.json are checked before a transfer
+    try:
+        priorities(entry)
+    except (TypeError, ValueError) as ex:
+        return Left(Issue(
+            message=f'invalid resources for entry {entry.name}: {ex}',
+            data={'resources': entry.resources},
+            include_traceback=False,
+        ))
+    profile = entry.profile or DEFAULT_PROFILE
+    base = profile.get('base', DEFAULT_PROFILE) if isinstance(profile, dict) else profile
+    if not isinstance(base, str) or base not in TRANSFER_PROFILES and profile != 'auto':
         return Left(Issue(
-            message='rsync REMOTE -> LOCAL failure',
-            data={'exit_code': exit_code},
+            message=f'invalid profile for entry {entry.name}: unknown profile {base!r}',
+            data={'profile': entry.profile},
+            include_traceback=False,
         ))
     return Right(True)
 
 
-def clean_local_directory(entry):
-    lines = open(f'{PYSYNC}/remove.txt').readlines()
-    if lines:
-        print_status(f'Deleting {len(lines)} local files/directories')
-    index = 0
-    total = cstr(C.blue, len(lines))
-    for line in reversed(lines):
-        index += 1
-        num = f'[{index+1}/{total}]:'
-        fname = f'{entry.local}{line[0:-1]}'
-        if fname[-1] == '/':
+def priority_prefix(entry):
+    # The shell lowers its own priorities so that every process it spawns
+    # (rsync, ssh, tar, ...) inherits them
+    nice, io_class, level = priorities(entry)
+    prefix = ''
+    if nice is not None:
+        prefix += f'renice -n {nice} -p $$ > /dev/null; '
+    if io_class is not None:
+        prefix += f'ionice -c {io_class}{"" if level is None else f" -n {level}"} -p $$; '
+    return prefix
+
+
+def governed(entry, cmd):
+    return f'{priority_prefix(entry)}{cmd}'
+
+
+def remote_rsync_options(entry):
+    # The rsync started over ssh runs with the same priorities
+    prefix = priority_prefix(entry)
+    return [f"--rsync-path='{prefix}rsync'"] if prefix else []
+
+
+def in_window(window, now):
+    if 'start' not in window or 'end' not in window:
+        return True
+    start, end = window['start'], window['end']
+    current = now.strftime('%H:%M')
+    if start <= end:
+        return start <= current < end
+    # Windows such as 22:00 - 06:00 wrap around midnight
+    return current >= start or current < end
+
+
+def bwlimit(entry, now=None):
+    limit = entry.resources.get('bwlimit')
+    if not isinstance(limit, list):
+        return limit
+    now = now or datetime.now()
+    return next(
+        (window.get('bwlimit') for window in limit if in_window(window, now)),
+        None,
+    )
+
+
+@contextmanager
+def file_lock(filename):
+    # Exclusive between threads and processes: every holder opens the file
+    with open(filename, 'a') as fpointer:
+        fcntl.flock(fpointer, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fpointer, fcntl.LOCK_UN)
+
+
+@contextmanager
+def entry_lock(entry):
+    # Held while an entry is synced, by any pysync process on this machine
+    fpointer = open(f'{data_dir(entry)}/sync.lock', 'w')
+    try:
+        fcntl.flock(fpointer, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        fpointer.close()
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        fcntl.flock(fpointer, fcntl.LOCK_UN)
+        fpointer.close()
+
+
+@contextmanager
+def transfer_slot():
+    # Slots are lock files shared by every pysync process on this machine
+    max_transfers = OPTIONS.get().max_transfers
+    if not max_transfers:
+        yield
+        return
+    slots = f'{PYSYNC}/slots'
+    os.makedirs(slots, exist_ok=True)
+    waiting = False
+    while True:
+        for index in range(max_transfers):
+            fpointer = open(f'{slots}/{index}.lock', 'w')
             try:
-                os.rmdir(fname)
-                print_info(num, fname, 'has been deleted')
-            except OSError:
-                print_info(num, fname, 'failed to deleted', C.red)
-        else:
+                fcntl.flock(fpointer, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                fpointer.close()
+                continue
             try:
-                os.remove(fname)
-                print_info(num, fname, 'has been deleted')
-            except OSError:
-                print_info(num, fname, 'failed to deleted', C.red)
-    return Right(True)
+                yield
+            finally:
+                fcntl.flock(fpointer, fcntl.LOCK_UN)
+                fpointer.close()
+            return
+        if not waiting:
+            print_status(f'Waiting for one of {max_transfers} transfer slots...')
+            waiting = True
+        time.sleep(1)
 
 
-def sync_local_to_remote(entry):
-    print_status('Calling rsync: LOCAL to REMOTE (DELETION)')
-    cmd = ' '.join(['rsync',
-        '-razuv',
-        '--progress',
-        '--delete',
-        f'{entry.local} {entry.remote}'
+def split_remote(remote):
+    if remote.startswith('/'):
+        return None, remote
+    host, path = remote.split(':', 1)
+    return host, path
+
+
+def is_empty_dir(path):
+    try:
+        with os.scandir(path) as items:
+            return next(items, None) is None
+    except FileNotFoundError:
+        return True
+
+
+# Runs the operations read from stdin (NUL separated) and writes the exit code
+# of each one. `~` is expanded as the shell would.
+REMOTE_BATCH_SCRIPT = r"""
+path() { case $1 in '~') p=$HOME;; '~/'*) p=$HOME/${1#'~/'};; *) p=$1;; esac; }
+while IFS= read -r -d '' op && IFS= read -r -d '' arg; do
+  path "$arg"
+  case $op in
+    rm) rm -f -- "$p";;
+    rmdir) rmdir -- "$p";;
+    isdir) [ -d "$p" ];;
+    empty) [ -d "$p" ] && [ -z "$(find "$p" -mindepth 1 -maxdepth 1 -print -quit)" ];;
+    mv) src=$p; IFS= read -r -d '' dst; path "$dst"
+        mkdir -p -- "$(dirname -- "$p")" &&
+        { [ -e "$p" ] || [ -L "$p" ] || mv -n -- "$src" "$p"; };;
+    *) false;;
+  esac 2> /dev/null
+  printf '%s\0' "$?"
+done
+"""
+
+
+class RemoteBatch:
+    """
+    Metadata operations on the files of one host (rm, rmdir, mv, isdir and
+    empty) collected and run together: a single ssh call for a remote host,
+    plain Python when `host` is None. Each method returns the index in
+    `results` of whether its operation succeeded once `run` is done. `mv`
+    does not overwrite an existing file.
+    """
+    def __init__(self, host, entry=None):
+        self.host = host
+        self.entry = entry
+        self.ops = []
+        self.results = []
+
+    def _add(self, *op):
+        self.ops.append(op)
+        return len(self.ops) - 1
+
+    def rm(self, path):
+        return self._add('rm', path)
+
+    def rmdir(self, path):
+        return self._add('rmdir', path)
+
+    def mv(self, src, dst):
+        return self._add('mv', src, dst)
+
+    def isdir(self, path):
+        return self._add('isdir', path)
+
+    def empty(self, path):
+        # An existing directory without any entry
+        return self._add('empty', path)
+
+    def run(self):
+        ops, self.ops = self.ops, []
+        if not ops:
+            self.results = []
+            return Right(self.results)
+        if self.host is None:
+            self.results = [self._run_local(*op) for op in ops]
+            return Right(self.results)
+        cmd = f"ssh {self.host} {shlex.quote('bash -c ' + shlex.quote(REMOTE_BATCH_SCRIPT))}"
+        if self.entry is not None:
+            cmd = governed(self.entry, cmd)
+        data = ''.join(f'{arg}\0' for op in ops for arg in op)
+        return pipe_cmd(cmd, data).flat_map(self._parse)
+
+    def _parse(self, out):
+        self.results = [code == '0' for code in out.split('\0')[:-1]]
+        return Right(self.results)
+
+    @staticmethod
+    def _run_local(op, path, dst=None):
+        path = os.path.expanduser(path)
+        try:
+            if op == 'rm':
+                if os.path.lexists(path):
+                    os.remove(path)
+            elif op == 'rmdir':
+                os.rmdir(path)
+            elif op == 'isdir':
+                return os.path.isdir(path)
+            elif op == 'empty':
+                return os.path.isdir(path) and is_empty_dir(path)
+            elif op == 'mv':
+                dst = os.path.expanduser(dst)
+                os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+                if not os.path.lexists(dst):
+                    os.rename(path, dst)
+        except OSError:
+            return False
+        return True
+
+
+def is_empty_remote(entry):
+    host, path = split_remote(entry.remote)
+    if host is None:
+        return Right(is_empty_dir(path))
+    batch = RemoteBatch(host, entry)
+    isdir = batch.isdir(path)
+    empty = batch.empty(path)
+
+    def checked(results):
+        if not results[isdir]:
+            return Left(Issue(
+                message='remote directory does not exist',
+                data={'remote': entry.remote},
+            ))
+        return Right(results[empty])
+    return batch.run().flat_map(checked)
+
+
+def tar_seedable(entry):
+    # Otherwise tar would leave out files that the rsync filters sync
+    ignore = load_ignore(entry)
+    return ignore is None or ignore.tar_compatible()
+
+
+def seed_direction(entry):
+    if entry.date_synced or not tar_seedable(entry):
+        return Right(None)
+    local_empty = is_empty_dir(entry.local)
+    return eval_iteration(lambda: [
+        direction
+        for remote_empty in is_empty_remote(entry)
+        for direction in [
+            'pull' if local_empty and not remote_empty else
+            'push' if remote_empty and not local_empty else
+            None
+        ]
     ])
-    exit_code = os.system(cmd)
-    if exit_code != 0:
-        return Left(Issue(
-            message='rsync LOCAL -> REMOTE failure',
-            data={'exit_code': exit_code},
-        ))
-    return Right(True)
 
 
-def record_sync(entries, index):
-    now = datetime.now()
-    print_status(f'Saving sync date: {now.strftime("%b/%d/%Y - %H:%M:%S")}')
-    entries[index].date_synced = int(datetime.timestamp(now))
-    return write_json([x.to_dict() for x in entries], SETTINGS)
+def tar_ignore_options(entry):
+    ignore = load_ignore(entry)
+    if ignore is None:
+        return ''
+    patterns = f'{entry_dir(entry)}/tar.exclude'
+    with open(patterns, 'w') as fpointer:
+        fpointer.write(''.join(f'{pattern}\n' for pattern in ignore.tar_patterns()))
+    return f'--exclude-from={patterns} '
+
+
+def seed_cmd(entry, direction):
+    host, path = split_remote(entry.remote)
+    src, dst = (entry.local, path) if direction == 'push' else (path, entry.local)
+    pack = f'tar -C {src} --exclude=.DS_Store {tar_ignore_options(entry)}-cf - .'
+    unpack = f'tar -C {dst} -xpf -'
+    compressor = OPTIONS.get().seed_compressor
+    if host and compressor:
+        compress, decompress = SEED_COMPRESSORS[compressor]
+        pack = f'{pack} | {compress}'
+        unpack = f'{decompress} | {unpack}'
+    if host is None:
+        pipeline = f'{pack} | {unpack}'
+    elif direction == 'push':
+        pipeline = f"{pack} | ssh {host} '{governed(entry, unpack)}'"
+    else:
+        pipeline = f"ssh {host} '{governed(entry, pack)}' | {unpack}"
+    return f'set -o pipefail; {pipeline}'
 
 
-def take_snapshot(entry):
-    print_status(f'Creating snapshot of {entry.local}')
-    cmd = ''.join([
-        f'cd {entry.local}; ',
-        # Make find show slash after directories
-        #  http://unix.stackexchange.com/a/4857
-        'find . -type d -exec sh -c \'printf "%s/\\n" "$0"\' {} \; -or -print',
-        # Need to delete ./ from the path:
-        #  http://stackoverflow.com/a/1571652/788553
-        f' | sed s:"./":: > {PYSYNC}/{entry.id}.txt'
-    ])
-    print(cmd)
-    exit_code = os.system(cmd)
+def seed_entry(entry, direction):
+    target = 'REMOTE' if direction == 'push' else 'LOCAL'
+    print_status(f'Seeding empty {target} directory with a tar stream')
+    cmd = governed(entry, seed_cmd(entry, direction))
+    with transfer_slot():
+        exit_code = run_cmd(cmd)
     if exit_code != 0:
         return Left(Issue(
-            message='failure storing snapshot',
+            message=f'tar stream seeding of {target} failure',
             data={
                 'exit_code': exit_code,
                 'cmd': cmd,
             },
         ))
-    return Right(True)
+    # Everything under the seeded directory is new
+    return append_changes(entry, target.lower(), [change('seeded', '')])
 
 
-def sync_entry(index, entries):
-    entry = entries[index]
-    if ANSWER_YES:
-        print(entry_str(index, entry))
-    return eval_iteration(lambda: [
-        True
-        for incoming, remote_missing in fetch_incoming(entry)
-        for _ in write_exclusions(entry, incoming)
-        for _ in write_removals(entry, remote_missing)
-        for _ in sync_remote_to_local(entry)
-        for _ in clean_local_directory(entry)
-        for _ in sync_local_to_remote(entry)
-        for _ in record_sync(entries, index)
-        for _ in take_snapshot(entry)
-    ])
-
+Stat = namedtuple('Stat', ['kind', 'size', 'mtime_ns'])
 
-def register(entries, local, remote, name):
-    entry_either = get_entry(entries, name) \
-        .swap() \
-        .flat_map_left(lambda _: Left(Issue(f'{name} already registered')))
-    return eval_iteration(lambda: [
-        True
-        for _ in entry_either
-        for new_entry in create_pair(local, remote, name)
-        for _ in write_json(
-            [x.to_dict() for x in entries + [new_entry]],
-            SETTINGS
-        )
-        for _ in print_msg(cstr(
-            C.cyan,
-            f'Registration successful. Run `pysync.py {name}` to sync entry.'
-        ))
-    ])
 
+def stat_info(info):
+    mode = info.st_mode
+    kind = 'l' if S_ISLNK(mode) else 'd' if S_ISDIR(mode) else 'f'
+    return Stat(kind, info.st_size, info.st_mtime_ns)
 
-def unregister(entries, name):
-    return eval_iteration(lambda: [
-        True
-        for index, entry in get_entry(entries, name)
-        for choice in should_proceed('\n'.join([
-            cstr(C.red, 'Are you sure you want to delete this entry:'),
-            entry_str(index, entry)
-        ]))
-        for _ in (remove_entry(entries, index) if choice else Right(True))
-        for _ in remove_entry_data(entry)
-    ])
 
+def lstat_path(path, follow=False):
+    try:
+        return stat_info(os.stat(path) if follow else os.lstat(path))
+    except OSError:
+        return None
 
-def reset_sync_date(entries, name):
-    return eval_iteration(lambda: [
-        True
-        for index, entry in get_entry(entries, name)
-        for choice in should_proceed('\n'.join([
-            cstr(C.yellow, 'Are you sure you want to reset this entry:'),
-            entry_str(index, entry)
-        ]))
-        for _ in (reset_entry(entries, index) if choice else Right(True))
-        for _ in remove_entry_data(entry)
-    ])
+
+def stat_group(dir_path, names, follow):
+    if len(names) < SCANDIR_MIN:
+        stats = {name: lstat_path(f'{dir_path}{name}') for name in names}
+    else:
+        wanted = set(names)
+        stats = dict.fromkeys(names)
+        try:
+            with os.scandir(dir_path) as items:
+                for item in items:
+                    if item.name in wanted:
+                        stats[item.name] = lstat_path(item.path)
+        except OSError:
+            pass
+    if follow:
+        # Same answer as os.path.isfile/isdir for symbolic links
+        for name, stat in stats.items():
+            if stat is not None and stat.kind == 'l':
+                stats[name] = lstat_path(f'{dir_path}{name}', True)
+    return stats
+
+
+def dir_spelling(rel, stat):
+    # A file does not answer for the same name spelled as a directory (a/)
+    return None if rel.endswith('/') and stat is not None and stat.kind == 'f' else stat
+
+
+def stat_paths(root, rels, follow=False):
+    # One lstat per path, siblings looked up together on a thread pool.
+    # Missing paths map to None. `a` and `a/` share one lookup.
+    groups = {}
+    for rel in rels:
+        parent, _, name = rel.rstrip('/').rpartition('/')
+        groups.setdefault(f'{parent}/' if parent else '', {}).setdefault(name, []).append(rel)
+    if not groups:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(STAT_WORKERS, len(groups))) as pool:
+        jobs = [
+            (names, pool.submit(stat_group, f'{root}{parent}', list(names), follow))
+            for parent, names in groups.items()
+        ]
+        return {
+            rel: dir_spelling(rel, stat)
+            for names, job in jobs
+            for name, stat in job.result().items()
+            for rel in names[name]
+        }
+
+
+class PathList:
+    """
+    Compact list of relative paths. Every directory prefix is stored once and
+    the remaining names are packed in a single buffer.
+    """
+    __slots__ = ('prefixes', 'prefix_ids', 'dir_ids', 'names', 'offsets')
+
+    def __init__(self, paths=()):
+        self.prefixes = []
+        self.prefix_ids = {}
+        self.dir_ids = array('I')
+        self.names = bytearray()
+        self.offsets = array('Q', [0])
+        for path in paths:
+            self.append(path)
+
+    def append(self, path):
+        # Directories end with / and keep it in their name
+        cut = path.rfind('/', 0, len(path) - 1) + 1
+        prefix = path[:cut]
+        dir_id = self.prefix_ids.get(prefix)
+        if dir_id is None:
+            dir_id = self.prefix_ids[prefix] = len(self.prefixes)
+            self.prefixes.append(prefix)
+        self.dir_ids.append(dir_id)
+        self.names += path[cut:].encode('utf-8', 'surrogateescape')
+        self.offsets.append(len(self.names))
+
+    def __len__(self):
+        return len(self.dir_ids)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        name = self.names[self.offsets[index]:self.offsets[index + 1]]
+        return self.prefixes[self.dir_ids[index]] + name.decode('utf-8', 'surrogateescape')
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+
+class FileTable:
+    """
+    Files listed by a dry run, stored by column: paths, modification times in
+    seconds and sizes. Iterating yields FileRecord views.
+    """
+    __slots__ = ('paths', 'mtimes', 'sizes')
+
+    def __init__(self, records=()):
+        self.paths = PathList()
+        self.mtimes = array('q')
+        self.sizes = array('q')
+        for path, mtime, size in records:
+            self.append(path, mtime, size)
+
+    def append(self, path, mtime, size):
+        self.paths.append(path)
+        self.mtimes.append(mtime)
+        self.sizes.append(size)
+
+    def __len__(self):
+        return len(self.mtimes)
+
+    def __getitem__(self, index):
+        return FileRecord(self, index if index >= 0 else index + len(self))
+
+    def __iter__(self):
+        return (FileRecord(self, index) for index in range(len(self)))
+
+
+class FileRecord:
+    """
+    One row of a FileTable. Unpacks like a (path, mtime, size) tuple.
+    """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def path(self):
+        return self.table.paths[self.index]
+
+    @property
+    def mtime(self):
+        return self.table.mtimes[self.index]
+
+    @property
+    def size(self):
+        return self.table.sizes[self.index]
+
+    def __iter__(self):
+        return iter((self.path, self.mtime, self.size))
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+
+def is_local_pair(entry):
+    return split_remote(entry.remote)[0] is None
+
+
+def posix_escape(char):
+    return f'\\{char}' if char in '.[]()*+?{}|^$\\' else char
+
+
+def ignore_regex(pattern, posix=False):
+    # posix: an extended regular expression for `find -regex` instead of a
+    # Python one
+    group = '(' if posix else '(?:'
+    escape = posix_escape if posix else re.escape
+    body = ''
+    index = 0
+    while index < len(pattern):
+        if pattern.startswith('**/', index):
+            body += f'{group}.*/)?'
+            index += 3
+        elif pattern.startswith('**', index):
+            body += '.*'
+            index += 2
+        elif pattern[index] == '*':
+            body += '[^/]*'
+            index += 1
+        elif pattern[index] == '?':
+            body += '[^/]'
+            index += 1
+        elif pattern[index] == '[' and ']' in pattern[index + 2:]:
+            end = pattern.index(']', index + 2)
+            chars = pattern[index + 1:end]
+            if not posix:
+                chars = chars.replace('\\', '\\\\')
+            body += f'[^{chars[1:]}]' if chars[0] == '!' else f'[{chars}]'
+            index = end + 1
+        else:
+            body += escape(pattern[index])
+            index += 1
+    # Patterns with a slash are relative to the root of the entry
+    anchored = '/' in pattern
+    return f'{"" if anchored else f"{group}.*/)?"}{body.lstrip("/")}'
+
+
+class IgnoreRules:
+    """
+    Patterns of a .pysyncignore file (gitignore syntax: `!` negates a pattern,
+    a trailing `/` only matches directories and the last matching pattern
+    wins). Ignored directories are not walked.
+    """
+    def __init__(self, lines):
+        self.rules = []
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            pattern = line[1:] if negated else line
+            dir_only = pattern.endswith('/')
+            self.rules.append((negated, dir_only, pattern.rstrip('/')))
+        self.negations = any(negated for negated, _, _ in self.rules)
+        self.compiled = [
+            (negated, dir_only, re.compile(ignore_regex(pattern)))
+            for negated, dir_only, pattern in self.rules
+        ]
+        # Without negations a single regex per kind of path is enough
+        self.file_regex = self._combine(False)
+        self.dir_regex = self._combine(True)
+
+    def _combine(self, is_dir):
+        patterns = [
+            ignore_regex(pattern)
+            for _, dir_only, pattern in self.rules
+            if is_dir or not dir_only
+        ]
+        return re.compile('|'.join(f'(?:{x})' for x in patterns)) if patterns else None
+
+    def match(self, rel, is_dir):
+        rel = rel.rstrip('/')
+        if not self.negations:
+            regex = self.dir_regex if is_dir else self.file_regex
+            return bool(regex and regex.fullmatch(rel))
+        for negated, dir_only, regex in reversed(self.compiled):
+            if (is_dir or not dir_only) and regex.fullmatch(rel):
+                return not negated
+        return False
+
+    def rsync_rules(self):
+        # rsync uses the first matching rule and anchors patterns with `/`
+        rules = []
+        for negated, dir_only, pattern in reversed(self.rules):
+            if '/' in pattern and not pattern.startswith('/'):
+                pattern = f'/{pattern}'
+            rules.append(f'{"+" if negated else "-"} {pattern}{"/" if dir_only else ""}')
+        return rules
+
+    def find_prune(self):
+        # Arguments of `find .` skipping ignored paths and directories; the
+        # remote cannot tell which rule matches last, negations are left to
+        # the caller
+        if self.negations or not self.rules:
+            return []
+        tests = []
+        for dir_only in (False, True):
+            patterns = [
+                ignore_regex(pattern, posix=True)
+                for _, only_dirs, pattern in self.rules
+                if only_dirs == dir_only
+            ]
+            if patterns:
+                regex = '\\./(' + '|'.join(f'({x})' for x in patterns) + ')'
+                tests.append(f'{"-type d " if dir_only else ""}-regex {shlex.quote(regex)}')
+        return ['-regextype posix-extended', '\\(', ' -o '.join(tests), '\\) -prune -o']
+
+    def tar_compatible(self):
+        # tar exclusions can neither be negated nor restricted to directories
+        return not any(negated or dir_only for negated, dir_only, _ in self.rules)
+
+    def tar_patterns(self):
+        return [
+            f'./{pattern.lstrip("/")}' if '/' in pattern else pattern
+            for _, _, pattern in self.rules
+        ]
+
+
+@lru_cache(maxsize=None)
+def compile_ignore(filename, _mtime_ns):
+    return IgnoreRules(read_lines(filename))
+
+
+def load_ignore(entry):
+    filename = f'{entry.local}{IGNORE_FILE}'
+    try:
+        return compile_ignore(filename, os.stat(filename).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+
+def ignore_options(entry):
+    ignore = load_ignore(entry)
+    if ignore is None:
+        return []
+    rules = f'{entry_dir(entry)}/filter.rules'
+    with open(rules, 'w') as fpointer:
+        fpointer.write(''.join(f'{rule}\n' for rule in ignore.rsync_rules()))
+    return [f"--filter='merge {rules}'"]
+
+
+def scan_tree(root, skip=(), ignore=None):
+    tree = {}
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(f'{root}{rel_dir}') as items:
+            for item in items:
+                if item.name in skip:
+                    continue
+                if item.is_symlink():
+                    kind, rel = 'l', f'{rel_dir}{item.name}'
+                elif item.is_dir(follow_symlinks=False):
+                    kind, rel = 'd', f'{rel_dir}{item.name}/'
+                else:
+                    kind, rel = 'f', f'{rel_dir}{item.name}'
+                # Ignored paths are neither stat'ed nor walked
+                if ignore is not None and ignore.match(rel, kind == 'd'):
+                    continue
+                if kind == 'd':
+                    stack.append(rel)
+                info = item.stat(follow_symlinks=False)
+                tree[rel] = Stat(kind, info.st_size, info.st_mtime_ns)
+    return tree
+
+
+def needs_update(src, dst):
+    # Same quick check as `rsync -u`: size and mtime (in seconds)
+    if dst is None or dst.kind != src.kind:
+        return True
+    if src.kind == 'd':
+        return False
+    src_time, dst_time = src.mtime_ns // 10**9, dst.mtime_ns // 10**9
+    if dst_time > src_time:
+        return False
+    return src.size != dst.size or src_time != dst_time
+
+
+def differs(src, dst):
+    # Same quick check as `rsync -a` without `-u`: a file newer on the
+    # destination is still listed
+    if dst is None or dst.kind != src.kind:
+        return True
+    if src.kind == 'd':
+        return False
+    return src.size != dst.size or src.mtime_ns // 10**9 != dst.mtime_ns // 10**9
+
+
+def native_diff(src_root, dst_root, ignore=None):
+    try:
+        skip = ('.DS_Store', PARTIAL_DIR)
+        src = scan_tree(src_root, skip, ignore)
+        dst = scan_tree(dst_root, skip, ignore)
+    except OSError as ex:
+        return Left(Issue(
+            message='failed to scan local directories',
+            data={'src': src_root, 'dst': dst_root},
+            cause=ex,
+        ))
+    incoming = FileTable(
+        (rel, stat.mtime_ns // 10**9, stat.size)
+        for rel, stat in sorted(src.items())
+        if differs(stat, dst.get(rel))
+    )
+    remote_missing = PathList(sorted((rel for rel in dst if rel not in src), reverse=True))
+    return Right((incoming, remote_missing))
+
+
+def reflink(fsrc, fdst):
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def copy_data(fsrc, fdst, size):
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    copied = 0
+    copiers = [
+        lambda: os.copy_file_range(infd, outfd, size - copied),
+        lambda: os.sendfile(outfd, infd, copied, size - copied),
+    ]
+    for copy in copiers:
+        try:
+            while copied < size:
+                sent = copy()
+                if sent == 0:
+                    break
+                copied += sent
+            return
+        except (AttributeError, OSError):
+            if copied:
+                raise
+    shutil.copyfileobj(fsrc, fdst)
+
+
+def copy_file(src, dst, kind):
+    if kind == 'l':
+        if os.path.lexists(dst):
+            os.remove(dst)
+        os.symlink(os.readlink(src), dst)
+        return
+    tmp = os.path.join(os.path.dirname(dst), f'.{os.path.basename(dst)}.pysync')
+    try:
+        with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            if not reflink(fsrc, fdst):
+                copy_data(fsrc, fdst, os.fstat(fsrc.fileno()).st_size)
+        shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+
+def file_hash(path):
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as fpointer:
+        for block in iter(lambda: fpointer.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_key(info):
+    return f'{info.st_dev}:{info.st_ino}:{info.st_size}:{info.st_mtime_ns}'
+
+
+class HashCache:
+    """
+    Content hashes (blake2b, same as `b2sum`) of files keyed by their device,
+    inode, size and mtime. Only files whose metadata changed are read again.
+    The least recently used hashes are dropped once `max_size` is reached.
+    """
+    def __init__(self, filename, max_size=HASH_CACHE_SIZE):
+        self.filename = filename
+        self.max_size = max_size
+        self.hashes = OrderedDict()
+        self.dirty = False
+
+    def load(self):
+        # It is only a cache: an unreadable file is started over
+        if os.path.isfile(self.filename):
+            self.hashes = self._read()
+            if self.hashes is None:
+                warning(f'ignoring unreadable hash cache {self.filename}')
+                self.hashes = OrderedDict()
+        return Right(self)
+
+    def _read(self):
+        result = read_json(self.filename)
+        try:
+            return OrderedDict(result.value) if result.right else None
+        except (TypeError, ValueError):
+            return None
+
+    def save(self):
+        if not self.dirty:
+            return Right(True)
+        self.dirty = False
+        # Syncs of the replicas of an entry share the cache: the hashes they
+        # saved since this one was loaded are kept
+        with file_lock(f'{self.filename}.lock'):
+            stored = self._read() if os.path.isfile(self.filename) else None
+            if stored:
+                for key, digest in self.hashes.items():
+                    stored[key] = digest
+                    stored.move_to_end(key)
+                self.hashes = stored
+                self._trim()
+            return replace_text(
+                json.dumps(list(self.hashes.items()), separators=(',', ':')),
+                self.filename,
+            )
+
+    def _store(self, key, digest):
+        self.hashes[key] = digest
+        self.hashes.move_to_end(key)
+        self.dirty = True
+        self._trim()
+
+    def _trim(self):
+        while len(self.hashes) > self.max_size:
+            self.hashes.popitem(last=False)
+
+    def hash_files(self, paths):
+        result = {}
+        missing = []
+        for path in paths:
+            try:
+                key = hash_key(os.stat(path))
+            except OSError:
+                continue
+            if key in self.hashes:
+                self.hashes.move_to_end(key)
+                result[path] = self.hashes[key]
+            else:
+                missing.append((path, key))
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+            jobs = [(path, key, pool.submit(file_hash, path)) for path, key in missing]
+            for path, key, job in jobs:
+                try:
+                    result[path] = job.result()
+                    # Files modified while being read are not cached
+                    if hash_key(os.stat(path)) == key:
+                        self._store(key, result[path])
+                except OSError:
+                    result.pop(path, None)
+        return result
+
+
+def load_hash_cache(entry):
+    # Local hashes are shared by all the replicas of an entry
+    return HashCache(f'{data_dir(entry)}/hashes.json').load()
+
+
+def same_content(src_root, dst_root, candidates, cache):
+    # Files with equal sizes which only differ in their mtime
+    hashes = cache.hash_files(
+        path
+        for rel in candidates
+        for path in (f'{src_root}{rel}', f'{dst_root}{rel}')
+    )
+    return set(
+        rel for rel in candidates
+        if hashes.get(f'{src_root}{rel}') is not None
+        and hashes.get(f'{src_root}{rel}') == hashes.get(f'{dst_root}{rel}')
+    )
+
+
+def is_excluded(rel, exclude):
+    parts = rel.rstrip('/').split('/')
+    return any('/'.join(parts[:i]) in exclude for i in range(1, len(parts) + 1))
+
+
+def other_kind(rel):
+    # The same name as a directory (trailing /) or as a file
+    return rel[:-1] if rel.endswith('/') else f'{rel}/'
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def native_copy(src_root, dst_root, cache, exclude=(), delete=False, ignore=None):
+    # Ignored paths are left alone on both sides, they are never deleted
+    src = scan_tree(src_root, ignore=ignore)
+    dst = scan_tree(dst_root, ignore=ignore)
+    exclude = set(x.rstrip('/') for x in exclude if x)
+    changed = [
+        (rel, stat)
+        for rel, stat in sorted(src.items())
+        if not is_excluded(rel, exclude) and needs_update(stat, dst.get(rel))
+    ]
+    unchanged = same_content(src_root, dst_root, [
+        rel
+        for rel, stat in changed
+        if stat.kind == 'f' and rel in dst and dst[rel].kind == 'f'
+        and dst[rel].size == stat.size
+    ], cache)
+    for rel in unchanged:
+        os.utime(f'{dst_root}{rel}', ns=(src[rel].mtime_ns, src[rel].mtime_ns))
+    changed = [(rel, stat) for rel, stat in changed if rel not in unchanged]
+    changes = [
+        change('updated' if rel in dst else 'created', rel, stat.size, stat.mtime_ns // 10**9)
+        for rel, stat in changed
+        if stat.kind != 'd' or rel not in dst
+    ]
+    for rel, stat in changed:
+        # A file replaced by a directory or a directory replaced by a file
+        if other_kind(rel) in dst:
+            remove_path(f'{dst_root}{other_kind(rel)}')
+        if stat.kind == 'd':
+            os.makedirs(f'{dst_root}{rel}', exist_ok=True)
+            emit('output', rel)
+    files = [(rel, stat) for rel, stat in changed if stat.kind != 'd']
+    with ThreadPoolExecutor(max_workers=COPY_WORKERS) as pool:
+        jobs = [
+            (rel, pool.submit(copy_file, f'{src_root}{rel}', f'{dst_root}{rel}', stat.kind))
+            for rel, stat in files
+        ]
+        for rel, job in jobs:
+            job.result()
+            emit('output', rel)
+    removed = 0
+    if delete:
+        for rel in sorted(dst, reverse=True):
+            if rel in src or other_kind(rel) in src or is_excluded(rel, exclude):
+                continue
+            try:
+                if rel[-1] == '/':
+                    os.rmdir(f'{dst_root}{rel}')
+                else:
+                    os.remove(f'{dst_root}{rel}')
+            except (FileNotFoundError, NotADirectoryError):
+                # Inside a directory replaced by a file
+                continue
+            except OSError as ex:
+                warning(f'cannot delete {rel}: {ex.strerror}')
+                continue
+            emit('output', f'deleting {rel}')
+            changes.append(change('deleted', rel))
+            removed += 1
+    # Directory times change while their contents are being updated
+    for rel, stat in changed:
+        if stat.kind == 'd':
+            shutil.copystat(f'{src_root}{rel}', f'{dst_root}{rel}')
+    emit('output', f'{len(files)} files copied, {removed} deleted')
+    return Right(changes)
+
+
+def native_sync(entry, src_root, dst_root, label, exclude=(), delete=False):
+    def copy(cache):
+        try:
+            return native_copy(
+                src_root, dst_root, cache, exclude, delete, load_ignore(entry))
+        except OSError as ex:
+            return Left(Issue(
+                message=f'native copy {label} failure',
+                data={'src': src_root, 'dst': dst_root},
+                cause=ex,
+            ))
+    with transfer_slot():
+        return eval_iteration(lambda: [
+            True
+            for cache in load_hash_cache(entry)
+            for changes in copy(cache)
+            for _ in cache.save()
+            for _ in append_changes(entry, label_side(label), changes)
+        ])
+
+
+class DryRunParser:
+    """
+    Incoming and deleted files of a dry run, read from the output of
+    rsync one line at a time. The header line and the summary after the
+    last blank line are not file names.
+    """
+
+    SUMMARY_LINES = 3
+
+    def __init__(self):
+        self.incoming = FileTable()
+        self.remote_missing = PathList()
+        self.header = True
+        self.pending = deque()
+
+    def feed(self, line):
+        if self.header:
+            self.header = False
+            return
+        self.pending.append(line)
+        if len(self.pending) > self.SUMMARY_LINES:
+            self._parse(self.pending.popleft())
+
+    def _parse(self, line):
+        items = line.split('<>')
+        if len(items) > 1:
+            fname, mtime, size = items
+            self.incoming.append(
+                fname,
+                int(datetime.strptime(mtime, '%Y/%m/%d-%H:%M:%S').timestamp()),
+                int(size),
+            )
+        else:
+            action = line.split(' ', 1)
+            if len(action) > 1:
+                self.remote_missing.append(action[1])
+
+    def result(self):
+        return Right((self.incoming, self.remote_missing))
+
+
+def fetch_incoming(entry, local=None):
+    print_status('Receiving list of incoming files...')
+    if local is None:
+        return dry_run(entry, entry.remote, entry.local)
+    # The remote builds its file list while the local directory is scanned
+    fetched, scanned = run_together(
+        dry_run_async(entry, entry.remote, entry.local),
+        in_thread(local.get),
+    )
+    return scanned.flat_map(lambda _: fetched)
+
+
+def dry_run_cmd(entry, src, dst):
+    profile = transfer_profile(entry)
+    cmd = ' '.join(['rsync',
+        '-nav',
+        *(['-z'] if profile.get('compress') else []),
+        '--delete',
+        '--exclude .DS_Store',
+        f'--exclude {PARTIAL_DIR}/',
+        *remote_rsync_options(entry),
+        *ignore_options(entry),
+        '--out-format="%n<>%M<>%l"',
+        f'{src} {dst}'
+    ])
+    return governed(entry, cmd)
+
+
+def dry_run(entry, src, dst):
+    # Files a transfer from src to dst would update and delete
+    if is_local_pair(entry):
+        return native_diff(src, dst, load_ignore(entry))
+    parser = DryRunParser()
+    return eval_iteration(lambda: [
+        (incoming, remote_missing)
+        for _ in stream_cmd(dry_run_cmd(entry, src, dst), parser.feed)
+        for incoming, remote_missing in parser.result()
+    ])
+
+
+async def dry_run_async(entry, src, dst):
+    if is_local_pair(entry):
+        return await in_thread(native_diff, src, dst, load_ignore(entry))
+    parser = DryRunParser()
+    result = await async_stream_cmd(dry_run_cmd(entry, src, dst), parser.feed)
+    return result.flat_map(lambda _: parser.result())
+
+
+def print_info(index, fpath, msg, color=None):
+    emit('info', msg, index=index, path=fpath, color=color)
+
+
+def print_msg(msg):
+    emit('message', msg)
+    return Right(0)
+
+
+def read_snapshot(entry):
+    try:
+        return set(read_lines(f'{PYSYNC}/{entry.id}.txt'))
+    except FileNotFoundError:
+        return set()
+
+
+def local_size(path):
+    try:
+        info = os.lstat(path)
+    except OSError:
+        # Missing, or a parent directory became a file
+        return None
+    return info.st_size if S_ISREG(info.st_mode) else None
+
+
+def file_size(stat):
+    return stat.size if stat is not None and stat.kind == 'f' else None
+
+
+def remote_hashes(entry, rels, cache):
+    host, path = split_remote(entry.remote)
+    if host is None:
+        hashes = cache.hash_files(f'{path}{rel}' for rel in rels)
+        return Right({
+            rel: hashes[f'{path}{rel}']
+            for rel in rels
+            if f'{path}{rel}' in hashes
+        })
+    if not rels:
+        return Right({})
+    # xargs exits with 123 when some of the files vanished
+    hash_cmd = f'xargs -0 -r -P {HASH_WORKERS} -n 64 b2sum -z --'
+    cmd = f"ssh {host} '{governed(entry, f'cd {path} && {hash_cmd}')}'"
+    data = ''.join(f'{rel}\0' for rel in rels)
+    return pipe_cmd(governed(entry, cmd), data, ok_codes=(0, 123)) \
+        .flat_map(lambda out: Right(dict(
+            reversed(line.split('  ', 1))
+            for line in out.split('\0')
+            if line
+        )))
+
+
+def match_moves(vanished, appeared):
+    # Each disappeared path is paired with one new path holding the same bytes
+    by_hash = {}
+    for rel, digest in appeared.items():
+        by_hash.setdefault(digest, []).append(rel)
+    moves = []
+    for rel, digest in sorted(vanished.items()):
+        if by_hash.get(digest):
+            moves.append((rel, by_hash[digest].pop()))
+    return moves
+
+
+def hash_candidates(vanished, appeared):
+    sizes = (set(vanished.values()) & set(appeared.values())) - {None}
+    return (
+        [rel for rel, size in vanished.items() if size in sizes],
+        [rel for rel, size in appeared.items() if size in sizes],
+    )
+
+
+def local_hashes(entry, rels, cache):
+    hashes = cache.hash_files(f'{entry.local}{rel}' for rel in rels)
+    return {
+        rel: hashes[f'{entry.local}{rel}']
+        for rel in rels
+        if f'{entry.local}{rel}' in hashes
+    }
+
+
+def move_remote_files(entry, moves):
+    if not moves:
+        return Right(True)
+    host, path = split_remote(entry.remote)
+    if host is None:
+        return move_local_files(path, moves)
+    batch = RemoteBatch(host, entry)
+    for old, new in moves:
+        batch.mv(f'{path}{old}', f'{path}{new}')
+
+    def moved(results):
+        failed = [move for move, ok in zip(moves, results) if not ok]
+        if not failed:
+            return Right(True)
+        return Left(Issue(
+            message='failed to move remote files',
+            data={'remote': entry.remote, 'moves': failed},
+        ))
+    return batch.run().flat_map(moved)
+
+
+def move_local_files(root, moves):
+    try:
+        for old, new in moves:
+            os.makedirs(os.path.dirname(f'{root}{new}'), exist_ok=True)
+            if not os.path.lexists(f'{root}{new}'):
+                os.rename(f'{root}{old}', f'{root}{new}')
+    except OSError as ex:
+        return Left(Issue(
+            message='failed to move files',
+            data={'root': root, 'moves': moves},
+            cause=ex,
+        ))
+    return Right(True)
+
+
+def find_moves(entry, incoming, remote_missing, cache):
+    snapshot = read_snapshot(entry)
+    synced_ns = (entry.date_synced or 0) * 10**9
+    stats = stat_paths(entry.local, list(incoming.paths) + list(remote_missing))
+    # Paths that moved locally: the remote still has the old path
+    local_old = {
+        rel: size
+        for rel, _, size in incoming
+        if rel in snapshot and stats[rel] is None
+    }
+    local_new = {
+        rel: file_size(stats[rel])
+        for rel in remote_missing
+        if rel not in snapshot
+    }
+    # Paths that moved remotely: the local directory still has the old path
+    remote_new = {
+        rel: size
+        for rel, _, size in incoming
+        if rel not in snapshot and stats[rel] is None
+    }
+    remote_old = {
+        rel: file_size(stats[rel])
+        for rel in remote_missing
+        if rel in snapshot
+        and file_size(stats[rel]) is not None
+        and stats[rel].mtime_ns <= synced_ns
+    }
+    old_remote, new_local = hash_candidates(local_old, local_new)
+    old_local, new_remote = hash_candidates(remote_old, remote_new)
+    return eval_iteration(lambda: [
+        (
+            match_moves(remote_old_hashes, local_hashes(entry, new_local, cache)),
+            match_moves(local_hashes(entry, old_local, cache), remote_new_hashes),
+        )
+        for remote_old_hashes in remote_hashes(entry, old_remote, cache)
+        for remote_new_hashes in remote_hashes(entry, new_remote, cache)
+    ])
+
+
+def apply_moves(entry, incoming, remote_missing, local=None):
+    if not entry.date_synced:
+        return Right((incoming, remote_missing))
+    print_status('Looking for files moved since the last sync...')
+
+    def apply(local_moves, remote_moves):
+        for old, new in local_moves:
+            print_info('[moved locally]:', old, f'moving remote copy to {new}', C.yellow)
+        for old, new in remote_moves:
+            print_info('[moved remotely]:', old, f'moving local copy to {new}', C.yellow)
+        if local:
+            local.refresh(rel for move in remote_moves for rel in move)
+        done = set(
+            rel
+            for old, new in local_moves + remote_moves
+            for rel in (old, new)
+        )
+        return eval_iteration(lambda: [
+            (
+                FileTable(x for x in incoming if x.path not in done) if done else incoming,
+                PathList(x for x in remote_missing if x not in done) if done else remote_missing,
+            )
+            for _ in append_changes(entry, 'remote', [
+                change('renamed', new, source=old) for old, new in local_moves])
+            for _ in append_changes(entry, 'local', [
+                change('renamed', new, source=old) for old, new in remote_moves])
+        ])
+
+    return eval_iteration(lambda: [
+        result
+        for cache in load_hash_cache(entry)
+        for local_moves, remote_moves in find_moves(entry, incoming, remote_missing, cache)
+        for _ in cache.save()
+        for _ in move_remote_files(entry, local_moves)
+        for _ in move_local_files(entry.local, remote_moves)
+        for result in apply(local_moves, remote_moves)
+    ])
+
+
+def identical_conflicts(entry, conflicts):
+    stats = stat_paths(entry.local, [in_file.path for _, in_file, _ in conflicts])
+    candidates = [
+        in_file.path
+        for _, in_file, _ in conflicts
+        if file_size(stats[in_file.path]) == in_file.size
+    ]
+    if not candidates:
+        return Right(set())
+    return eval_iteration(lambda: [
+        set(
+            rel
+            for rel in candidates
+            if rel in local and local[rel] == remote.get(rel)
+        )
+        for cache in load_hash_cache(entry)
+        for remote in remote_hashes(entry, candidates, cache)
+        for local in [local_hashes(entry, candidates, cache)]
+        for _ in cache.save()
+    ])
+
+
+def resolve_conflicts(entry, conflicts, identical, tree=None):
+    same = []
+    renames = []
+    for num, in_file, local_ns in conflicts:
+        fname = in_file.path
+        file_path = f'{entry.local}{fname}'
+        if fname in identical:
+            # Matching the remote time keeps the LOCAL to REMOTE pass quiet
+            os.utime(file_path, (in_file.mtime, in_file.mtime))
+            print_info(num, fname, 'has identical content on both sides', C.green)
+            same.append(fname)
+        else:
+            (dir_name, file_name) = os.path.split(fname)
+            host = socket.gethostname()
+            stamp = datetime.fromtimestamp(local_ns / 10**9).strftime("%Y_%m_%d-%H_%M_%S")
+            new_name = f'{dir_name}/{file_name}-{host}-{stamp}'
+            os.rename(file_path, f'{entry.local}{new_name}')
+            print_info(num, fname, f'renamed to {new_name}', C.yellow)
+            renames.append((fname, new_name.lstrip('/')))
+            if tree is not None:
+                tree[new_name.lstrip('/')] = tree.pop(fname)
+    with open(f'{entry_dir(entry)}/exclude.txt', 'a') as fpointer:
+        fpointer.write(''.join(f'{fname}\n' for fname in same))
+    return append_changes(entry, 'local', [
+        change('conflict', new, source=old) for old, new in renames
+    ]).flat_map(lambda _: Right(renames))
+
+
+def local_stats(entry, names, tree=None):
+    # Symbolic links are followed. Uses the scan of the local directory when
+    # one is available.
+    if tree is None:
+        return stat_paths(entry.local, names, True)
+    stats = {}
+    links = []
+    for fname in names:
+        name = fname.rstrip('/')
+        stat = dir_spelling(fname, tree.get(f'{name}/') or tree.get(name))
+        if stat is not None and stat.kind == 'l':
+            links.append(fname)
+        else:
+            stats[fname] = stat
+    stats.update(stat_paths(entry.local, links, True))
+    return stats
+
+
+def kind_of(stat):
+    return stat.kind if stat is not None else None
+
+
+def write_exclusions(entry, incoming, tree=None):
+    if incoming:
+        print_status(f'Analysing {len(incoming)} incoming files to avoid erroneous overwriting...')
+    exclude_list = []
+    conflicts = []
+    total = cstr(C.blue, len(incoming))
+    synced_ns = (entry.date_synced or 0) * 10**9
+    stats = local_stats(entry, incoming.paths, tree)
+    for index, in_file in enumerate(incoming):
+        fname = in_file.path
+        num = f'[{index+1}/{total}]:'
+        stat = stats[fname]
+        kind = kind_of(stat)
+        if kind == 'f':
+            if stat.mtime_ns > synced_ns:
+                if in_file.mtime * 10**9 > synced_ns:
+                    conflicts.append((num, in_file, stat.mtime_ns))
+                else:
+                    print_info(num, fname, 'has been modified locally', C.red)
+            else:
+                print_info(num, fname, 'has not been modified')
+        elif kind == 'd':
+            print_info(num, fname, 'is an existing directory')
+        else:
+            print_info(num, fname, 'may be excluded', C.yellow)
+            exclude_list.append(fname)
+    write_known(entry, exclude_list, 'exclude.txt')
+    if conflicts:
+        print_status(f'Comparing the contents of {len(conflicts)} files modified on both sides...')
+    return eval_iteration(lambda: [
+        renames
+        for identical in identical_conflicts(entry, conflicts)
+        for renames in resolve_conflicts(entry, conflicts, identical, tree)
+    ])
+
+
+def write_removals(entry, remote_missing, tree=None):
+    if remote_missing:
+        print_status(f'Analysing {len(remote_missing)} local files to avoid erroneous removal...')
+    removal_list = []
+    total = cstr(C.blue, len(remote_missing))
+    synced_ns = (entry.date_synced or 0) * 10**9
+    stats = local_stats(entry, remote_missing, tree)
+    for index, fname in enumerate(remote_missing):
+        num = f'[{index+1}/{total}]:'
+        stat = stats[fname]
+        if kind_of(stat) == 'f':
+            if stat.mtime_ns > synced_ns:
+                print_info(num, fname, 'has been modified - will stay')
+            else:
+                print_info(num, fname, ' may require deletion', C.yellow)
+                removal_list.append(fname)
+        else:
+            print_info(num, fname, 'may require directory deletion', C.yellow)
+            removal_list.append(fname)
+    write_known(entry, removal_list, 'remove.txt')
+    return Right(True)
+
+
+def read_lines(filename):
+    with open(filename) as fpointer:
+        return fpointer.read().splitlines()
+
+
+def write_known(entry, candidates, name):
+    # Only paths present at the last sync are kept, in snapshot order
+    candidates = set(candidates)
+    try:
+        snapshot = read_lines(f'{PYSYNC}/{entry.id}.txt')
+    except FileNotFoundError:
+        snapshot = []
+    with open(f'{entry_dir(entry)}/{name}', 'w') as fpointer:
+        fpointer.write(''.join(f'{rel}\n' for rel in snapshot if rel in candidates))
+
+
+def link_basis(entry, renames):
+    # rsync looks for a basis file at the same relative path in --copy-dest
+    basis = f'{entry_dir(entry)}/basis/'
+    shutil.rmtree(basis, ignore_errors=True)
+    linked = 0
+    for fname, new_name in renames:
+        os.makedirs(os.path.dirname(f'{basis}{fname}'), exist_ok=True)
+        try:
+            os.link(f'{entry.local}{new_name}', f'{basis}{fname}')
+            linked += 1
+        except OSError:
+            pass
+    return basis, linked
+
+
+def basis_options(entry, renames):
+    if not renames:
+        return []
+    basis, linked = link_basis(entry, renames)
+    options = [f'--copy-dest={basis}'] if linked else []
+    if linked < len(renames):
+        # Conflict copies sit next to the original name
+        options.append('--fuzzy')
+    return options
+
+
+def read_history(entry):
+    filename = f'{entry_dir(entry)}/history.json'
+    if not os.path.isfile(filename):
+        return []
+    result = read_json(filename)
+    return result.value if result.right else []
+
+
+def auto_profile(entry):
+    runs = [run for run in read_history(entry) if run['seconds'] > 0]
+    if not runs:
+        return DEFAULT_PROFILE
+    rates = sorted(run['wire_bytes'] / run['seconds'] for run in runs)
+    if rates[len(rates) // 2] >= AUTO_LAN_RATE:
+        return 'lan'
+    ratios = [run['ratio'] for run in runs if run.get('ratio') is not None]
+    if ratios and sum(ratios) / len(ratios) >= AUTO_INCOMPRESSIBLE:
+        return 'media'
+    return 'wan'
+
+
+def transfer_profile(entry):
+    profile = entry.profile or DEFAULT_PROFILE
+    if profile == 'auto':
+        profile = auto_profile(entry)
+    if isinstance(profile, dict):
+        # Custom profiles override the settings of a named base profile
+        return dict(TRANSFER_PROFILES[profile.get('base', DEFAULT_PROFILE)], **profile)
+    return TRANSFER_PROFILES[profile]
+
+
+def profile_options(profile):
+    options = []
+    if profile.get('compress'):
+        options.append('-z')
+        if profile.get('compress_choice'):
+            options.append(f'--compress-choice={profile["compress_choice"]}')
+        if profile.get('compress_level') is not None:
+            options.append(f'--compress-level={int(profile["compress_level"])}')
+        if profile.get('skip_compress'):
+            options.append(f'--skip-compress={"/".join(profile["skip_compress"])}')
+    if profile.get('whole_file'):
+        options.append('--whole-file')
+    if profile.get('checksum_choice'):
+        options.append(f'--checksum-choice={profile["checksum_choice"]}')
+    return options
+
+
+def profile_passes(profile):
+    # Options of each rsync call. rsync does not allow --partial-dir together
+    # with --inplace, so the files below the in place size get their own pass.
+    options = profile_options(profile)
+    partial = f'--partial-dir={PARTIAL_DIR}'
+    if not profile.get('inplace'):
+        return [options + [partial]]
+    min_size = profile.get('inplace_min_size', INPLACE_MIN_SIZE)
+    return [
+        options + [partial, f'--max-size={min_size}-1'],
+        options + ['--inplace', f'--min-size={min_size}'],
+    ]
+
+
+FEED_LOCK = threading.Lock()
+
+
+def change(action, path, size=None, mtime=None, source=None):
+    record = OrderedDict([('action', action), ('path', path)])
+    if source is not None:
+        record['from'] = source
+    if size is not None:
+        record['size'] = size
+    if mtime is not None:
+        record['mtime'] = mtime
+    return record
+
+
+def label_side(label):
+    # Labels of transfers are of the form `REMOTE -> LOCAL`
+    return 'local' if label.endswith('LOCAL') else 'remote'
+
+
+def append_changes(entry, side, changes):
+    if not changes:
+        return Right(True)
+    stamp = int(time.time())
+    text = ''.join(
+        json.dumps(OrderedDict([
+            ('date', stamp),
+            ('side', side),
+            ('remote', entry.remote),
+            *item.items(),
+        ])) + '\n'
+        for item in changes
+    )
+    filename = f'{data_dir(entry)}/changes'
+    try:
+        # Replicas of an entry share the feed
+        with FEED_LOCK, open(filename, 'a') as fpointer:
+            fpointer.write(text)
+    except OSError as ex:
+        return Left(Issue(
+            message='failed to append to the change feed',
+            data={'filename': filename},
+            cause=ex,
+        ))
+    return Right(True)
+
+
+def read_changes(entry, cursor=0):
+    # The cursor is the byte offset following the last change a consumer
+    # processed. Every change carries the cursor to resume after it.
+    filename = f'{data_dir(entry)}/changes'
+    try:
+        with open(filename, 'rb') as fpointer:
+            fpointer.seek(cursor)
+            data = fpointer.read()
+    except FileNotFoundError:
+        return Right([])
+    changes = []
+    try:
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b'\n'):
+                # Still being written
+                break
+            cursor += len(line)
+            item = json.loads(line, object_pairs_hook=OrderedDict)
+            item['cursor'] = cursor
+            changes.append(item)
+    except ValueError as ex:
+        return Left(Issue(
+            message='invalid change feed',
+            data={'filename': filename, 'cursor': cursor},
+            cause=ex,
+        ))
+    return Right(changes)
+
+
+def parse_rsync_log(filename):
+    items = []
+    wire_bytes = 0
+    try:
+        lines = read_lines(filename)
+    except FileNotFoundError:
+        return items, wire_bytes
+    for line in lines:
+        # Log lines start with a date, time and the rsync pid
+        message = line.split('] ', 1)[-1]
+        fields = message.split('<>')
+        if len(fields) == 5:
+            items.append(fields)
+        elif message.startswith('sent '):
+            words = message.replace(',', '').split()
+            wire_bytes += int(words[1]) + int(words[4])
+    return items, wire_bytes
+
+
+def compress_ratio(root, names, limit=20, size=256 * 1024):
+    original = compressed = 0
+    for name in names[:limit]:
+        try:
+            with open(f'{root}{name}', 'rb') as fpointer:
+                data = fpointer.read(size)
+        except OSError:
+            continue
+        original += len(data)
+        compressed += len(zlib.compress(data, 1))
+    return compressed / original if original else None
+
+
+def rsync_changes(items):
+    # Itemized changes: `>f+++++++++` is a new file, `>f.st......` an update
+    # and `*deleting` a removal. Attribute-only updates are left out.
+    changes = []
+    for flags, name, mtime, size, _ in items:
+        if flags.startswith('*deleting'):
+            changes.append(change('deleted', name))
+            continue
+        if flags[0] not in '<>c' or (flags[1] == 'd' and flags[2:5] != '+++'):
+            continue
+        try:
+            mtime = int(datetime.strptime(mtime, '%Y/%m/%d-%H:%M:%S').timestamp())
+        except ValueError:
+            mtime = None
+        action = 'created' if flags[2:5] == '+++' else 'updated'
+        changes.append(change(action, name, int(size), mtime))
+    return changes
+
+
+def record_attempt(entry, log, side):
+    # Files an attempt transferred reach the feed even when it failed
+    items, wire_bytes = parse_rsync_log(log)
+    return append_changes(entry, side, rsync_changes(items)) \
+        .flat_map(lambda _: Right((items, wire_bytes)))
+
+
+def record_history(entry, items, wire_bytes, seconds):
+    files = [fields for fields in items if fields[0][1] == 'f']
+    if not files:
+        return Right(True)
+    run = {
+        'date': int(time.time()),
+        'files': len(files),
+        'bytes': sum(int(fields[3]) for fields in files),
+        'wire_bytes': wire_bytes or sum(int(fields[4]) for fields in files),
+        'seconds': round(seconds, 3),
+        'ratio': compress_ratio(entry.local, [fields[1] for fields in files]),
+    }
+    history = (read_history(entry) + [run])[-HISTORY_SIZE:]
+    return write_json(history, f'{entry_dir(entry)}/history.json')
+
+
+def run_rsync(entry, args, label):
+    log = f'{entry_dir(entry)}/rsync.log'
+    seconds = 0
+    items = []
+    wire_bytes = 0
+    for options in profile_passes(transfer_profile(entry)):
+        result = rsync_pass(entry, options, args, label, log)
+        if not result.right:
+            return result
+        pass_seconds, pass_items, pass_wire_bytes = result.value
+        seconds += pass_seconds
+        items += pass_items
+        wire_bytes += pass_wire_bytes
+    return record_history(entry, items, wire_bytes, seconds)
+
+
+def rsync_pass(entry, options, args, label, log):
+    # Files completed by a failed attempt pass rsync's quick check on the next
+    # one and interrupted files resume from the partial directory
+    seconds = 0
+    items = []
+    wire_bytes = 0
+    retried = set()
+    for attempt in range(RSYNC_RETRIES + 1):
+        # The bandwidth limit is picked again in case a time window changed
+        limit = bwlimit(entry)
+        cmd = governed(entry, ' '.join([
+            'rsync',
+            f'--timeout={RSYNC_TIMEOUT}',
+            f'--log-file={log}',
+            f"--log-file-format='{RSYNC_LOG_FORMAT}'",
+            *options,
+            *remote_rsync_options(entry),
+            *ignore_options(entry),
+            *([f'--bwlimit={limit}'] if limit else []),
+            *args,
+        ]))
+        # Each attempt logs only what it transferred
+        if os.path.isfile(log):
+            os.remove(log)
+        with transfer_slot():
+            start = time.time()
+            exit_code = run_cmd(cmd)
+            seconds += time.time() - start
+        recorded = record_attempt(entry, log, label_side(label))
+        if not recorded.right:
+            return recorded
+        items += recorded.value[0]
+        wire_bytes += recorded.value[1]
+        if exit_code == 0:
+            return Right((seconds, items, wire_bytes))
+        if exit_code == RSYNC_VANISHED:
+            warning(f'rsync {label}: some files vanished before they could be transferred')
+            return Right((seconds, items, wire_bytes))
+        reason = RSYNC_RETRY_CODES.get(exit_code)
+        if reason is None or attempt == RSYNC_RETRIES or exit_code in retried:
+            break
+        if exit_code in RSYNC_RETRY_ONCE:
+            retried.add(exit_code)
+        delay = RSYNC_BACKOFF * 2 ** attempt
+        warning(f'rsync {label}: {reason} (exit code {exit_code}), retrying in {delay}s')
+        time.sleep(delay)
+    return Left(Issue(
+        message=f'rsync {label} failure',
+        data={
+            'exit_code': exit_code,
+            'reason': reason,
+            'attempts': attempt + 1,
+        },
+    ))
+
+
+def sync_remote_to_local(entry, renames=()):
+    if is_local_pair(entry):
+        print_status('Copying: REMOTE to LOCAL (UPDATE/NO DELETION)')
+        exclude = read_lines(f'{entry_dir(entry)}/exclude.txt')
+        return native_sync(entry, entry.remote, entry.local, 'REMOTE -> LOCAL', exclude)
+    print_status('Calling rsync: REMOTE to LOCAL (UPDATE/NO DELETION)')
+    result = run_rsync(entry, [
+        '-rauv',
+        '--progress',
+        f'--exclude-from {entry_dir(entry)}/exclude.txt',
+        *basis_options(entry, renames),
+        f'{entry.remote} {entry.local}'
+    ], 'REMOTE -> LOCAL')
+    shutil.rmtree(f'{entry_dir(entry)}/basis/', ignore_errors=True)
+    return result
+
+
+def open_dir(name, dir_fd=None):
+    return os.open(
+        name,
+        os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW,
+        dir_fd=dir_fd,
+    )
+
+
+def open_rel_dir(root, rel_dir):
+    # Every component is opened with O_NOFOLLOW so symlinks are never followed
+    fd = open_dir(root)
+    try:
+        for name in filter(None, rel_dir.split('/')):
+            parent, fd = fd, None
+            try:
+                fd = open_dir(name, parent)
+            finally:
+                os.close(parent)
+    except OSError:
+        if fd is not None:
+            os.close(fd)
+        raise
+    return fd
+
+
+def remove_subtree(parent_fd, name, rel, targets, counts):
+    fd = open_dir(name, parent_fd)
+    kept = 0
+    try:
+        with os.scandir(fd) as items:
+            children = list(items)
+        for item in children:
+            child = f'{rel}{item.name}'
+            try:
+                if item.is_dir(follow_symlinks=False):
+                    if f'{child}/' not in targets:
+                        kept += 1
+                    elif not remove_subtree(fd, item.name, f'{child}/', targets, counts):
+                        kept += 1
+                elif child in targets:
+                    os.unlink(item.name, dir_fd=fd)
+                    counts['files'] += 1
+                    counts['removed'].append(child)
+                else:
+                    kept += 1
+            except FileNotFoundError:
+                pass
+            except OSError as ex:
+                counts['failed'].append((child, ex.strerror))
+                kept += 1
+    finally:
+        os.close(fd)
+    if kept:
+        # Entries created locally since the last sync are not removed
+        counts['kept'].append(rel)
+        return False
+    os.rmdir(name, dir_fd=parent_fd)
+    counts['dirs'] += 1
+    counts['removed'].append(rel)
+    return True
+
+
+def remove_group(root, parent, names, targets):
+    counts = {'files': 0, 'dirs': 0, 'kept': [], 'failed': [], 'removed': []}
+    try:
+        parent_fd = open_rel_dir(root, parent)
+    except FileNotFoundError:
+        return counts
+    except OSError as ex:
+        counts['failed'].append((parent, ex.strerror))
+        return counts
+    try:
+        for name in names:
+            rel = f'{parent}{name}'
+            try:
+                if rel.endswith('/'):
+                    remove_subtree(parent_fd, name[:-1], rel, targets, counts)
+                else:
+                    os.unlink(name, dir_fd=parent_fd)
+                    counts['files'] += 1
+                    counts['removed'].append(rel)
+            except FileNotFoundError:
+                pass
+            except OSError as ex:
+                counts['failed'].append((rel, ex.strerror))
+    finally:
+        os.close(parent_fd)
+    return counts
+
+
+def group_removals(targets):
+    # Only the topmost listed paths are visited, their listed children are
+    # removed while walking each subtree
+    groups = {}
+    for rel in targets:
+        parent, name = os.path.split(rel.rstrip('/'))
+        parent = f'{parent}/' if parent else ''
+        if parent and parent in targets:
+            continue
+        groups.setdefault(parent, []).append(name + ('/' if rel.endswith('/') else ''))
+    return groups
+
+
+def clean_local_directory(entry):
+    targets = set(x for x in read_lines(f'{entry_dir(entry)}/remove.txt') if x)
+    if not targets:
+        return Right(True)
+    print_status(f'Deleting {len(targets)} local files/directories')
+    totals = {'files': 0, 'dirs': 0, 'kept': [], 'failed': [], 'removed': []}
+    groups = group_removals(targets)
+    with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as pool:
+        jobs = [
+            pool.submit(remove_group, entry.local, parent, names, targets)
+            for parent, names in groups.items()
+        ]
+        for job in jobs:
+            counts = job.result()
+            for key, value in counts.items():
+                totals[key] += value
+    for rel in sorted(totals['kept']):
+        print_info('[kept]:', rel, 'contains new local files', C.yellow)
+    for rel, reason in sorted(totals['failed']):
+        print_info('[failed]:', rel, f'failed to delete: {reason}', C.red)
+    print_info(
+        cstr(C.blue, '[deleted]:'),
+        f'{totals["files"]} files',
+        f'and {totals["dirs"]} directories',
+    )
+    return append_changes(entry, 'local', [
+        change('deleted', rel) for rel in sorted(totals['removed'])
+    ])
+
+
+def delete_remote_files(entry):
+    # Excluded paths of the last snapshot that are missing locally were deleted
+    # locally: they are removed in one batch instead of by rsync --delete.
+    # Directories which are not empty are left to rsync.
+    try:
+        exclude = [x for x in read_lines(f'{entry_dir(entry)}/exclude.txt') if x]
+    except FileNotFoundError:
+        return Right(True)
+    stats = stat_paths(entry.local, exclude)
+    deleted = sorted((rel for rel in exclude if stats[rel] is None), reverse=True)
+    if not deleted:
+        return Right(True)
+    print_status(f'Deleting {len(deleted)} remote files/directories')
+    host, path = split_remote(entry.remote)
+    batch = RemoteBatch(host, entry)
+    for rel in deleted:
+        (batch.rmdir if rel.endswith('/') else batch.rm)(f'{path}{rel}')
+    return batch.run().flat_map(lambda results: append_changes(entry, 'remote', [
+        change('deleted', rel) for rel, ok in zip(deleted, results) if ok
+    ]))
+
+
+def sync_local_to_remote(entry):
+    if is_local_pair(entry):
+        print_status('Copying: LOCAL to REMOTE (DELETION)')
+        return native_sync(
+            entry, entry.local, entry.remote, 'LOCAL -> REMOTE', delete=True)
+    if not delete_remote_files(entry).right:
+        warning('unable to delete remote files in one batch, leaving them to rsync')
+    print_status('Calling rsync: LOCAL to REMOTE (DELETION)')
+    return run_rsync(entry, [
+        '-rauv',
+        '--progress',
+        '--delete',
+        f'{entry.local} {entry.remote}'
+    ], 'LOCAL -> REMOTE')
+
+
+def is_ignored(ignore, rel):
+    # Paths inside an ignored directory are ignored too
+    parts = rel.split('/')
+    return any(
+        ignore.match('/'.join(parts[:depth]), True)
+        for depth in range(1, len(parts))
+    ) or ignore.match(rel, False)
+
+
+def tree_hashes(entry, root, cache):
+    try:
+        tree = scan_tree(root, ('.DS_Store', PARTIAL_DIR), load_ignore(entry))
+    except OSError as ex:
+        return Left(Issue(
+            message='failed to scan directory',
+            data={'root': root},
+            cause=ex,
+        ))
+    files = [f'{root}{rel}' for rel, stat in tree.items() if stat.kind == 'f']
+    hashes = cache.hash_files(files)
+    return Right({
+        path[len(root):]: hashes[path]
+        for path in files
+        if path in hashes
+    })
+
+
+def remote_tree_hashes(entry):
+    # The remote machine lists and hashes its files in parallel, the whole
+    # tree is streamed back over a single ssh channel. find skips the
+    # ignored directories, the rules it cannot apply are applied here.
+    host, path = split_remote(entry.remote)
+    ignore = load_ignore(entry)
+    script = ' '.join([
+        f'{priority_prefix(entry)}cd {path} && find .',
+        *(ignore.find_prune() if ignore else []),
+        f'-name {PARTIAL_DIR} -type d -prune -o',
+        '-type f ! -name .DS_Store -print0 |',
+        f'xargs -0 -r -P {HASH_WORKERS} -n 64 b2sum -z --',
+    ])
+    cmd = f'ssh {host} {shlex.quote(script)}'
+    return pipe_cmd(governed(entry, cmd), '', ok_codes=(0, 123)) \
+        .flat_map(lambda out: Right({
+            rel[2:]: digest
+            for digest, rel in (line.split('  ', 1) for line in out.split('\0') if line)
+            if ignore is None or not is_ignored(ignore, rel[2:])
+        }))
+
+
+def hash_sides(entry, views, cache):
+    # Hashing local directories shares the cache and is done in one thread
+    # while every remote machine hashes its own tree
+    local_views = [view for view in views if is_local_pair(view)]
+    remote_views = [view for view in views if not is_local_pair(view)]
+
+    def local_side():
+        return sequence(
+            [tree_hashes(entry, entry.local, cache)] +
+            [tree_hashes(view, view.remote, cache) for view in local_views]
+        )
+    found = run_together(
+        in_thread(local_side),
+        *(in_thread(remote_tree_hashes, view) for view in remote_views)
+    )
+    return eval_iteration(lambda: [
+        (local, dict(zip(local_views + remote_views, local_remotes + remotes)))
+        for local, *local_remotes in found[0]
+        for remotes in sequence(found[1:])
+    ])
+
+
+def compare_hashes(local, remote):
+    return sorted(
+        [(rel, 'differs') for rel in local if rel in remote and local[rel] != remote[rel]] +
+        [(rel, 'missing remotely') for rel in local if rel not in remote] +
+        [(rel, 'missing locally') for rel in remote if rel not in local]
+    )
+
+
+def verify_entry(entry):
+    views = [replica_view(entry, i) for i in range(len(entry.remotes))] \
+        if entry.replicas else [entry]
+    print_status(f'Comparing the contents of {entry.local} and {", ".join(entry.remotes)}...')
+
+    def report(local, remotes):
+        total = 0
+        for view in views:
+            mismatches = compare_hashes(local, remotes[view])
+            for rel, reason in mismatches:
+                print_info('[mismatch]:', rel, f'{reason} on {view.remote}', C.red)
+            if not mismatches:
+                print_status(f'{len(local)} files match on {view.remote}')
+            total += len(mismatches)
+        if total:
+            return Left(Issue(
+                message=f'{total} files do not match',
+                data={'local': entry.local, 'remotes': entry.remotes},
+                include_traceback=False,
+            ))
+        return Right(True)
+    return eval_iteration(lambda: [
+        True
+        for _ in check_settings(entry)
+        for cache in load_hash_cache(entry)
+        for local, remotes in hash_sides(entry, views, cache)
+        for _ in cache.save()
+        for _ in report(local, remotes)
+    ])
+
+
+def record_sync(entries, index):
+    now = datetime.now()
+    print_status(f'Saving sync date: {now.strftime("%b/%d/%Y - %H:%M:%S")}')
+    return update_entry(entries[index], date_synced=int(datetime.timestamp(now)))
+
+
+def take_snapshot(entry):
+    print_status(f'Creating snapshot of {entry.local}')
+    snapshot = f'{PYSYNC}/{entry.id}.txt'
+    try:
+        # Parents are listed before their children, directories end with /
+        tree = scan_tree(entry.local, (PARTIAL_DIR,), load_ignore(entry))
+        with open(snapshot, 'w') as fpointer:
+            fpointer.write(''.join(f'{rel}\n' for rel in sorted(tree)))
+    except OSError as ex:
+        return Left(Issue(
+            message='failure storing snapshot',
+            data={'snapshot': snapshot},
+            cause=ex,
+        ))
+    return Right(True)
+
+
+def snapshot_fingerprint(entry):
+    try:
+        info = os.stat(f'{PYSYNC}/{entry.id}.txt')
+    except FileNotFoundError:
+        return None
+    return [info.st_size, info.st_mtime_ns]
+
+
+def modified_since(entry, root, stamp):
+    # Looks for a file (not a directory: syncing changes their times) of the
+    # local or remote root modified after the stamp and stops at the first one
+    host, path = split_remote(root)
+    if host is not None:
+        cmd = (
+            f"ssh {host} 'cd {path} && find . -name {PARTIAL_DIR} -prune -o "
+            f"! -type d -newermt @{int(stamp)} -print -quit'"
+        )
+        return eval_cmd(governed(entry, cmd)).flat_map(lambda out: Right(out != ''))
+    try:
+        stack = [path]
+        while stack:
+            with os.scandir(stack.pop()) as items:
+                for item in items:
+                    if item.name == PARTIAL_DIR:
+                        continue
+                    if item.is_dir(follow_symlinks=False):
+                        stack.append(item.path)
+                    elif item.stat(follow_symlinks=False).st_mtime_ns > stamp * 10**9:
+                        return Right(True)
+    except OSError as ex:
+        return Left(Issue(message='failed to scan directory', data={'root': root}, cause=ex))
+    return Right(False)
+
+
+class Journal:
+    """
+    Records the phases of a sync that completed along with their outputs so
+    that an interrupted sync resumes from the first incomplete phase. Large
+    outputs (the fetched file lists) are written once to their own file and
+    the journal itself stays small. Files deleted after the last completed
+    phase are not detected (see algorithm.md).
+    """
+    def __init__(self, entry):
+        self.entry = entry
+        self.filename = f'{entry_dir(entry)}/journal.json'
+        self.data = None
+
+    def _new(self):
+        return {
+            'version': VERSION,
+            'started': int(time.time()),
+            'date_synced': self.entry.date_synced,
+            'snapshot': snapshot_fingerprint(self.entry),
+            'remotes': self.entry.remotes,
+            # Time the last phase completed
+            'updated': time.time(),
+            'phases': OrderedDict(),
+            # Phases whose output is in its own file
+            'outputs': [],
+        }
+
+    def _is_valid(self, data):
+        # No other sync completed in between and no file of either side was
+        # modified since the last completed phase
+        return (
+            data.get('version') == VERSION
+            and time.time() - data.get('started', 0) < JOURNAL_MAX_AGE
+            and self.entry.date_synced in (
+                data.get('date_synced'),
+                data['phases'].get('record'),
+            )
+            and data.get('snapshot') == snapshot_fingerprint(self.entry)
+            and data.get('remotes') == self.entry.remotes
+            and all(os.path.isfile(self._output_file(x)) for x in data.get('outputs', []))
+            and not self._modified(data['updated'])
+        )
+
+    def _modified(self, stamp):
+        # A side which cannot be checked counts as modified
+        for root in [self.entry.local] + self.entry.remotes:
+            result = modified_since(self.entry, root, stamp)
+            if not result.right or result.value:
+                return True
+        return False
+
+    def load(self):
+        self.data = self._new()
+        if not os.path.isfile(self.filename):
+            return Right(self)
+        result = read_json(self.filename)
+        if result.right and self._is_valid(result.value):
+            self.data = result.value
+            self.data['phases'] = OrderedDict(self.data['phases'])
+            print_status(f'Resuming interrupted sync after: {", ".join(self.data["phases"])}')
+        elif result.right and result.value.get('phases'):
+            print_status('Discarding the journal of an interrupted sync')
+        return Right(self)
+
+    def run(self, phase, fct, encode=lambda x: x, decode=lambda x: x, separate=False):
+        if phase in self.data['phases']:
+            saved = read_json(self._output_file(phase)) \
+                if phase in self.data.get('outputs', []) else Right(self.data['phases'][phase])
+            return saved.flat_map(lambda out: Right(decode(out)))
+        return eval_iteration(lambda: [
+            out
+            for out in fct()
+            for _ in self._complete(phase, encode(out), separate)
+        ])
+
+    def _output_file(self, phase):
+        return f'{entry_dir(self.entry)}/journal-{phase}.json'
+
+    def _complete(self, phase, out, separate):
+        if separate:
+            saved = replace_text(json.dumps(out), self._output_file(phase))
+            if not saved.right:
+                return saved
+            self.data['outputs'].append(phase)
+            out = None
+        self.data['phases'][phase] = out
+        self.data['updated'] = time.time()
+        return replace_text(json.dumps(self.data), self.filename)
+
+    def clear(self):
+        for filename in [self.filename] + [self._output_file(x) for x in self.data['outputs']]:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+        return Right(True)
+
+
+def encode_changes(changes):
+    incoming, remote_missing = changes
+    return [
+        [list(in_file) for in_file in incoming],
+        list(remote_missing),
+    ]
+
+
+def decode_changes(data):
+    incoming, remote_missing = data
+    return (
+        FileTable((fname, int(mtime), size) for fname, mtime, size in incoming),
+        PathList(remote_missing),
+    )
+
+
+def fetch_changes(entry, local=None):
+    return eval_iteration(lambda: [
+        changes
+        for fetched, missing in fetch_incoming(entry, local)
+        for changes in apply_moves(entry, fetched, missing, local)
+    ])
+
+
+def remote_host(view):
+    return split_remote(view.remote)[0] or socket.gethostname()
+
+
+def replica_conflicts(views, changes):
+    # A path changed on several replicas is received from the replica with the
+    # newest copy, the other copies are first renamed on their replica
+    sources = {}
+    for view_index, (incoming, _) in enumerate(changes):
+        for fname, mtime, size in incoming:
+            if not fname.endswith('/'):
+                sources.setdefault(fname, []).append((mtime, size, view_index))
+    moves = [[] for _ in views]
+    for fname, copies in sorted(sources.items()):
+        if len(set((mtime, size) for mtime, size, _ in copies)) < 2:
+            continue
+        copies.sort(reverse=True)
+        for mtime, _, view_index in copies[1:]:
+            (dir_name, file_name) = os.path.split(fname)
+            host = remote_host(views[view_index])
+            stamp = datetime.fromtimestamp(mtime).strftime("%Y_%m_%d-%H_%M_%S")
+            new_name = os.path.join(dir_name, f'{file_name}-{host}-{stamp}')
+            moves[view_index].append((fname, new_name))
+    return moves
+
+
+def split_replica_conflicts(views, changes):
+    def rename(view, view_changes, view_moves):
+        incoming, remote_missing = view_changes
+        for old, new in view_moves:
+            print_info('[replica conflict]:', old, f'renamed to {new} on {view.remote}', C.yellow)
+        renamed = dict(view_moves)
+        return move_remote_files(view, view_moves).flat_map(lambda _: append_changes(
+            view, 'remote', [change('conflict', new, source=old) for old, new in view_moves]
+        )).flat_map(lambda _: Right((
+            FileTable(
+                (renamed.get(fname, fname), mtime, size)
+                for fname, mtime, size in incoming
+            ) if renamed else incoming,
+            remote_missing,
+        )))
+    return sequence(
+        rename(view, view_changes, view_moves)
+        for view, view_changes, view_moves
+        in zip(views, changes, replica_conflicts(views, changes))
+    )
+
+
+def run_concurrently(fct, items):
+    # Each thread reports through the options of the caller
+    contexts = [copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=max(1, len(items))) as pool:
+        return sequence(list(pool.map(
+            lambda ctx, item: ctx.run(fct, item), contexts, items)))
+
+
+def fetch_replicas(views, local):
+    return eval_iteration(lambda: [
+        changes
+        for fetched in run_concurrently(lambda view: fetch_changes(view, local), views)
+        for changes in split_replica_conflicts(views, fetched)
+    ])
+
+
+class LocalTree:
+    """
+    Scan of the local directory computed once and shared by the analysis of
+    every replica. The scan runs while the remotes build their file lists;
+    moves and conflict renames update it in place.
+    """
+    def __init__(self, entry):
+        self.entry = entry
+        self.tree = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.tree is None:
+                print_status(f'Scanning {self.entry.local}')
+                try:
+                    self.tree = scan_tree(
+                        self.entry.local, (PARTIAL_DIR,), load_ignore(self.entry))
+                except OSError as ex:
+                    return Left(Issue(
+                        message='failed to scan local directory',
+                        data={'local': self.entry.local},
+                        cause=ex,
+                    ))
+            return Right(self.tree)
+
+    def refresh(self, paths):
+        if self.tree is None:
+            return
+        for rel in paths:
+            # Parents may have been created to hold a moved file
+            parts = rel.split('/')
+            for depth in range(1, len(parts)):
+                self.update('/'.join(parts[:depth]) + '/')
+            self.update(rel)
+
+    def update(self, rel):
+        try:
+            info = os.lstat(f'{self.entry.local}{rel}')
+        except FileNotFoundError:
+            self.tree.pop(rel, None)
+            return
+        self.tree[rel] = stat_info(info)
+
+
+def write_replica_exclusions(views, changes, local):
+    return local.get().flat_map(lambda tree: sequence(
+        write_exclusions(view, incoming, tree)
+        for view, (incoming, _) in zip(views, changes)
+    ))
+
+
+def write_replica_removals(entry, views, changes, local):
+    # Paths received from any replica are never removed
+    incoming = set(fname for view_incoming, _ in changes for fname in view_incoming.paths)
+    return eval_iteration(lambda: [
+        True
+        for tree in local.get()
+        for _ in sequence(
+            write_removals(view, remote_missing, tree)
+            for view, (_, remote_missing) in zip(views, changes)
+        )
+        for removals in [set(
+            rel
+            for view in views
+            for rel in read_lines(f'{entry_dir(view)}/remove.txt')
+        )]
+        for _ in write_text(''.join(
+            f'{rel}\n'
+            for rel in read_lines(f'{PYSYNC}/{entry.id}.txt')
+            if rel in removals and rel not in incoming
+        ), f'{entry_dir(entry)}/remove.txt')
+    ])
+
+
+def fan_out_sync(entries, index):
+    entry = entries[index]
+    views = [replica_view(entry, i) for i in range(len(entry.remotes))]
+    local = LocalTree(entry)
+    journal = Journal(entry)
+    return eval_iteration(lambda: [
+        True
+        for _ in journal.load()
+        for changes in journal.run(
+            'fetch', lambda: fetch_replicas(views, local),
+            lambda data: [encode_changes(x) for x in data],
+            lambda data: [decode_changes(x) for x in data],
+            separate=True)
+        for renames in journal.run(
+            'exclusions', lambda: write_replica_exclusions(views, changes, local),
+            decode=lambda data: [[tuple(x) for x in y] for y in data])
+        for _ in journal.run(
+            'removals', lambda: write_replica_removals(entry, views, changes, local))
+        for _ in journal.run('pull', lambda: run_concurrently(
+            lambda args: sync_remote_to_local(*args), list(zip(views, renames))))
+        for _ in journal.run('clean', lambda: clean_local_directory(entry))
+        for _ in journal.run('push', lambda: run_concurrently(sync_local_to_remote, views))
+        for _ in journal.run('record', lambda: record_sync(entries, index).flat_map(
+            lambda _: Right(entry.date_synced)))
+        for _ in take_snapshot(entry)
+        for _ in journal.clear()
+    ])
+
+
+def seed_replica(view):
+    # A new replica receives the local directory before its first sync so
+    # that the files it is missing are not taken as remote deletions
+    if is_local_pair(view):
+        print_status('Copying: LOCAL to REPLICA (NO DELETION)')
+        return native_sync(view, view.local, view.remote, 'LOCAL -> REPLICA')
+    return eval_iteration(lambda: [
+        True
+        for empty in is_empty_remote(view)
+        for _ in (
+            seed_entry(view, 'push') if empty and tar_seedable(view) else
+            run_rsync(view, [
+                '-rauv',
+                '--progress',
+                f'{view.local} {view.remote}'
+            ], 'LOCAL -> REPLICA')
+        )
+    ])
+
+
+def add_replica(entries, remote, name):
+    return eval_iteration(lambda: [
+        True
+        for index, entry in get_entry(entries, name)
+        for remote_dir in check_remote(remote)
+        for _ in (
+            Left(Issue(f'{remote_dir} is already a remote of {entry.name}'))
+            if remote_dir in entry.remotes else Right(True)
+        )
+        for choice in should_proceed('\n'.join([
+            cstr(C.yellow, f'Are you sure you want to copy the entry to {remote_dir}?'),
+            entry_str(index, entry)
+        ]))
+        for _ in (
+            update_entry_replicas(entries, index, remote_dir) if choice else Right(True)
+        )
+    ])
+
+
+def update_entry_replicas(entries, index, remote):
+    entry = entries[index]
+    view = replica_view(entry, len(entry.remotes), remote)
+    return eval_iteration(lambda: [
+        True
+        for _ in check_settings(entry)
+        for _ in seed_replica(view)
+        for _ in update_entry(entry, replicas=entry.replicas + [remote])
+    ])
+
+
+def plan_item(fname, size, action):
+    # Symbolic links and unknown sizes count as 0 bytes
+    return {'path': fname, 'bytes': size or 0, 'action': action}
+
+
+def median_throughput(entry):
+    rates = sorted(
+        run['bytes'] / run['seconds']
+        for run in read_history(entry)
+        if run['seconds'] > 0
+    )
+    return rates[len(rates) // 2] if rates else None
+
+
+def build_plan(entry, fetched, sent, moves):
+    incoming, remote_missing = fetched
+    outgoing, remote_extra = sent
+    local_moves, remote_moves = moves
+    snapshot = read_snapshot(entry)
+    synced_ns = (entry.date_synced or 0) * 10**9
+    moved = set(rel for old, new in local_moves + remote_moves for rel in (old, new))
+    pulled = set(incoming.paths)
+    stats = local_stats(entry, list(incoming.paths) + list(remote_missing))
+    items = []
+    for fname, mtime, size in incoming:
+        if fname in moved or fname.endswith('/'):
+            continue
+        stat = stats[fname]
+        if kind_of(stat) == 'f' and stat.mtime_ns > synced_ns \
+                and mtime * 10**9 > synced_ns:
+            items.append(plan_item(fname, size, 'conflict'))
+            items.append(plan_item(fname, stat.size, 'push'))
+        elif stat is None and fname in snapshot:
+            continue
+        items.append(plan_item(fname, size, 'pull'))
+    deleted = set()
+    for fname in remote_missing:
+        stat = stats[fname]
+        if fname in moved or fname not in snapshot:
+            continue
+        if kind_of(stat) == 'f' and stat.mtime_ns > synced_ns:
+            continue
+        deleted.add(fname)
+        items.append(plan_item(fname, file_size(stat), 'delete_local'))
+    for fname, _, size in outgoing:
+        if fname in moved or fname in pulled or fname in deleted or fname.endswith('/'):
+            continue
+        items.append(plan_item(fname, size, 'push'))
+    for fname in remote_extra:
+        if fname in snapshot and fname not in moved:
+            items.append(plan_item(fname, 0, 'delete_remote'))
+    actions = OrderedDict(
+        (action, {'files': 0, 'bytes': 0})
+        for action in ['pull', 'push', 'conflict', 'delete_local', 'delete_remote']
+    )
+    for item in items:
+        actions[item['action']]['files'] += 1
+        actions[item['action']]['bytes'] += item['bytes']
+    actions['move'] = {
+        'local_to_remote': len(local_moves),
+        'remote_to_local': len(remote_moves),
+        'bytes_saved': sum(
+            local_size(f'{entry.local}{rel}') or 0
+            for rel in [new for _, new in local_moves] + [old for old, _ in remote_moves]
+        ),
+    }
+    throughput = median_throughput(entry)
+    eta = dict(
+        (direction, actions[direction]['bytes'] / throughput if throughput else None)
+        for direction in ['pull', 'push']
+    )
+    return Right(OrderedDict([
+        ('remote', entry.remote),
+        ('actions', actions),
+        ('largest', sorted(
+            (x for x in items if x['action'] in ('pull', 'push')),
+            key=lambda x: -x['bytes'],
+        )[:PLAN_LARGEST]),
+        ('throughput', throughput),
+        ('eta_seconds', eta),
+    ]))
+
+
+def plan_remote(entry):
+    def moves(cache, incoming, remote_missing):
+        if not entry.date_synced:
+            return Right(([], []))
+        return find_moves(entry, incoming, remote_missing, cache)
+    print_status(f'Comparing {entry.local} with {entry.remote}...')
+    pulled, pushed = run_together(
+        dry_run_async(entry, entry.remote, entry.local),
+        dry_run_async(entry, entry.local, entry.remote),
+    )
+    return eval_iteration(lambda: [
+        plan
+        for fetched in pulled
+        for sent in pushed
+        for cache in load_hash_cache(entry)
+        for found in moves(cache, *fetched)
+        for plan in build_plan(entry, fetched, sent, found)
+    ])
+
+
+def plan_entry(entry):
+    views = [replica_view(entry, i) for i in range(len(entry.remotes))] \
+        if entry.replicas else [entry]
+
+    def total(plans):
+        etas = [plan['eta_seconds'] for plan in plans]
+        known = all(eta[d] is not None for eta in etas for d in eta)
+        return Right(OrderedDict([
+            ('entry', entry.name),
+            ('local', entry.local),
+            ('date_synced', entry.date_synced),
+            ('remotes', plans),
+            # Replicas are pulled and pushed concurrently
+            ('eta_seconds', sum(
+                max(eta[direction] for eta in etas)
+                for direction in ['pull', 'push']
+            ) if known else None),
+        ]))
+    return eval_iteration(lambda: [
+        plan
+        for _ in check_settings(entry)
+        for plans in sequence(plan_remote(view) for view in views)
+        for plan in total(plans)
+    ])
+
+
+def plan(entries, name):
+    return eval_iteration(lambda: [
+        True
+        for _, entry in get_entry(entries, name)
+        for data in plan_entry(entry)
+        for text in to_json(data)
+        for _ in print_msg(text)
+    ])
+
+
+def print_changes(entries, name, cursor):
+    return eval_iteration(lambda: [
+        True
+        for _, entry in get_entry(entries, name)
+        for items in read_changes(entry, cursor)
+        for _ in sequence(print_msg(json.dumps(item)) for item in items)
+    ])
+
+
+def verify(entries, name):
+    return eval_iteration(lambda: [
+        True
+        for _, entry in get_entry(entries, name)
+        for _ in verify_entry(entry)
+    ])
+
+
+def seed_sync(entries, index, direction):
+    entry = entries[index]
+    return eval_iteration(lambda: [
+        True
+        for _ in seed_entry(entry, direction)
+        for _ in record_sync(entries, index)
+        for _ in take_snapshot(entry)
+    ])
+
+
+def full_sync(entries, index):
+    entry = entries[index]
+    local = LocalTree(entry)
+    journal = Journal(entry)
+    return eval_iteration(lambda: [
+        True
+        for _ in journal.load()
+        for incoming, remote_missing in journal.run(
+            'fetch', lambda: fetch_changes(entry, local), encode_changes, decode_changes,
+            separate=True)
+        for renames in journal.run(
+            'exclusions', lambda: local.get().flat_map(
+                lambda tree: write_exclusions(entry, incoming, tree)),
+            decode=lambda data: [tuple(x) for x in data])
+        for _ in journal.run(
+            'removals', lambda: local.get().flat_map(
+                lambda tree: write_removals(entry, remote_missing, tree)))
+        for _ in journal.run('pull', lambda: sync_remote_to_local(entry, renames))
+        for _ in journal.run('clean', lambda: clean_local_directory(entry))
+        for _ in journal.run('push', lambda: sync_local_to_remote(entry))
+        for _ in journal.run('record', lambda: record_sync(entries, index).flat_map(
+            lambda _: Right(entry.date_synced)))
+        for _ in take_snapshot(entry)
+        for _ in journal.clear()
+    ])
+
+
+def sync_entry(index, entries):
+    entry = entries[index]
+    with entry_lock(entry) as locked:
+        if not locked:
+            return Left(Issue(
+                message=f'{entry.name} is already being synced',
+                data={'locked': True},
+                include_traceback=False,
+            ))
+        return locked_sync(index, entries)
+
+
+def locked_sync(index, entries):
+    entry = entries[index]
+    if OPTIONS.get().answer_yes:
+        emit('entry', entry_str(index, entry), name=entry.name)
+    return eval_iteration(lambda: [
+        True
+        for _ in check_settings(entry)
+        for direction in (Right(None) if entry.replicas else seed_direction(entry))
+        for _ in (
+            seed_sync(entries, index, direction) if direction else
+            fan_out_sync(entries, index) if entry.replicas else
+            full_sync(entries, index)
+        )
+        for _ in (verify_entry(entry) if entry.verify else Right(True))
+    ])
+
+
+def register(entries, local, remote, name):
+    entry_either = get_entry(entries, name) \
+        .swap() \
+        .flat_map_left(lambda _: Left(Issue(f'{name} already registered')))
+    return eval_iteration(lambda: [
+        True
+        for _ in entry_either
+        for new_entries in create_pairs(entries, [(local, remote, name)])
+        for _ in add_entries(entries, new_entries)
+        for _ in print_msg(cstr(
+            C.cyan,
+            f'Registration successful. Run `pysync.py {name}` to sync entry.'
+        ))
+    ])
+
+
+def register_many(entries, specs):
+    return eval_iteration(lambda: [
+        new_entries
+        for new_entries in create_pairs(entries, specs)
+        for _ in add_entries(entries, new_entries)
+    ])
+
+
+def unregister(entries, name):
+    return eval_iteration(lambda: [
+        True
+        for index, entry in get_entry(entries, name)
+        for choice in should_proceed('\n'.join([
+            cstr(C.red, 'Are you sure you want to delete this entry:'),
+            entry_str(index, entry)
+        ]))
+        for _ in (remove_entry(entries, index) if choice else Right(True))
+        for _ in remove_entry_data(entry)
+    ])
+
+
+def reset_sync_date(entries, name):
+    return eval_iteration(lambda: [
+        True
+        for index, entry in get_entry(entries, name)
+        for choice in should_proceed('\n'.join([
+            cstr(C.yellow, 'Are you sure you want to reset this entry:'),
+            entry_str(index, entry)
+        ]))
+        for _ in (reset_entry(entries, index) if choice else Right(True))
+        for _ in remove_entry_data(entry)
+    ])
 
 
 def update_name(entries, new_name, name):
@@ -650,6 +3498,292 @@ def sync(entries, name):
     ])
 
 
+class SyncResult:
+    def __init__(self, name, either, started, duration, events):
+        self.name = name
+        self.ok = either.right
+        self.issue = None if either.right else either.value
+        self.started = started
+        self.duration = duration
+        self.events = events
+
+    def to_dict(self):
+        return OrderedDict([
+            ('name', self.name),
+            ('ok', self.ok),
+            ('issue', self.issue.to_dict() if self.issue else None),
+            ('started', self.started),
+            ('duration', self.duration),
+            ('events', [x.to_dict() for x in self.events]),
+        ])
+
+
+class SyncPlan:
+    def __init__(self, name, either, events):
+        self.name = name
+        self.ok = either.right
+        self.issue = None if either.right else either.value
+        data = either.value if either.right else {}
+        self.remotes = data.get('remotes', [])
+        self.eta_seconds = data.get('eta_seconds')
+        self.data = data
+        self.events = events
+
+    def to_dict(self):
+        return OrderedDict([
+            ('name', self.name),
+            ('ok', self.ok),
+            ('issue', self.issue.to_dict() if self.issue else None),
+            ('plan', self.data),
+        ])
+
+
+class SyncEngine:
+    """
+    Library access to the entries in pysync.json. Nothing is printed and no
+    confirmation is asked: progress goes to `on_event(name, event)` and every
+    call returns a result object. Different entries may be synced at the same
+    time from threads or from asyncio; calls for the same entry wait for each
+    other.
+    """
+    def __init__(self, on_event=None, seed_compressor=None, max_transfers=None,
+                 workers=8):
+        self.on_event = on_event
+        self.seed_compressor = seed_compressor
+        self.max_transfers = max_transfers
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    @property
+    def entries(self):
+        # Read on every call: other pysync processes may change the entries
+        return self._value(load_entries())
+
+    @staticmethod
+    def _value(either):
+        if not either.right:
+            raise either.value
+        return either.value
+
+    def _entry_lock(self, entry):
+        with self._lock:
+            return self._locks.setdefault(entry.id, threading.Lock())
+
+    def _call(self, name, fct, events):
+        def on_event(event):
+            events.append(event)
+            if self.on_event:
+                self.on_event(name, event)
+
+        def run():
+            OPTIONS.set(Options(
+                colors=False,
+                answer_yes=True,
+                seed_compressor=self.seed_compressor,
+                max_transfers=self.max_transfers,
+                on_event=on_event,
+            ))
+            return fct()
+        return copy_context().run(run)
+
+    def close(self):
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def names(self):
+        return [entry.name for entry in self.entries]
+
+    def register(self, local, remote, name):
+        entries = self.entries
+        self._value(self._call(
+            name, lambda: register(entries, local, remote, name), []))
+        return entries[-1]
+
+    def register_many(self, specs):
+        # specs are (local, remote, name) tuples, the remote directories of
+        # each host are checked with a single ssh call
+        entries = self.entries
+        return self._value(self._call(
+            ', '.join(name for _, _, name in specs),
+            lambda: register_many(entries, specs), []))
+
+    def plan(self, name):
+        events = []
+        result = self._call(name, lambda: eval_iteration(lambda: [
+            data
+            for _, entry in get_entry(self.entries, name)
+            for data in plan_entry(entry)
+        ]), events)
+        return SyncPlan(name, result, events)
+
+    def sync(self, name):
+        events = []
+        started = time.time()
+        entries = self.entries
+        found = get_entry(entries, name)
+        if not found.right:
+            return SyncResult(name, found, started, 0, events)
+        index, entry = found.value
+        with self._entry_lock(entry):
+            result = self._call(
+                name, lambda: sync_entry(index, entries), events)
+        return SyncResult(name, result, started, time.time() - started, events)
+
+    def verify(self, name):
+        events = []
+        started = time.time()
+        result = self._call(name, lambda: verify(self.entries, name), events)
+        return SyncResult(name, result, started, time.time() - started, events)
+
+    def changes(self, name, cursor=0):
+        return self._value(eval_iteration(lambda: [
+            items
+            for _, entry in get_entry(self.entries, name)
+            for items in read_changes(entry, cursor)
+        ]))
+
+    def sync_many(self, names=None):
+        return list(self._pool.map(self.sync, names or self.names()))
+
+    async def plan_async(self, name):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, self.plan, name)
+
+    async def sync_async(self, name):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, self.sync, name)
+
+    async def sync_many_async(self, names=None):
+        return list(await asyncio.gather(*(
+            self.sync_async(name) for name in names or self.names()
+        )))
+
+
+def parse_interval(value):
+    # Seconds, or a number followed by s, m, h or d
+    if isinstance(value, str) and value[-1:] in INTERVAL_UNITS:
+        return float(value[:-1]) * INTERVAL_UNITS[value[-1]]
+    return float(value)
+
+
+class Scheduler:
+    """
+    Syncs every entry with an `interval` again and again. Start times are
+    spread with a random jitter, entries that keep failing back off
+    exponentially and at most `max_syncs` entries are synced at once. The
+    next run of each entry is kept in ~/.pysync/<id>/schedule.json.
+    """
+    def __init__(self, engine, names=None, max_syncs=MAX_SYNCS):
+        self.engine = engine
+        self.names = names
+        self.max_syncs = max_syncs
+        self.running = {}
+
+    def entries(self):
+        return [
+            entry for entry in self.engine.entries
+            if entry.interval and (not self.names or entry.name in self.names)
+        ]
+
+    def state(self, entry):
+        filename = f'{data_dir(entry)}/schedule.json'
+        result = read_json(filename) if os.path.isfile(filename) else Left(None)
+        if result.right:
+            return result.value
+        # The first runs are spread over a fraction of the interval
+        interval = parse_interval(entry.interval)
+        state = {
+            'next_run': time.time() + random.uniform(0, interval * SCHEDULE_JITTER),
+            'failures': 0,
+        }
+        write_json(state, filename)
+        return state
+
+    def finish(self, entry, job):
+        try:
+            result = job.result()
+        except Exception as ex:
+            result = SyncResult(entry.name, Left(Issue(
+                message='unexpected failure',
+                cause=ex,
+            )), time.time(), 0, [])
+        state = self.state(entry)
+        interval = parse_interval(entry.interval)
+        if result.ok:
+            state['failures'] = 0
+        elif not (result.issue.data or {}).get('locked'):
+            state['failures'] += 1
+            print_info(
+                '[failed]:', entry.name,
+                f'{result.issue.message} ({state["failures"]} in a row)', C.red)
+        delay = min(interval * 2 ** state['failures'], max(interval, SCHEDULE_MAX_BACKOFF))
+        state['last_run'] = int(result.started)
+        state['last_ok'] = result.ok
+        state['next_run'] = time.time() + delay + random.uniform(0, delay * SCHEDULE_JITTER)
+        return write_json(state, f'{data_dir(entry)}/schedule.json')
+
+    def collect(self, wait=False):
+        # Entries removed or unscheduled while they synced only free their slot
+        entries = {entry.id: entry for entry in self.entries()}
+        for entry_id, job in list(self.running.items()):
+            if wait or job.done():
+                del self.running[entry_id]
+                if entry_id in entries:
+                    self.finish(entries[entry_id], job)
+
+    def tick(self, pool):
+        self.collect()
+        due = sorted(
+            (state['next_run'], index, entry)
+            for index, entry in enumerate(self.entries())
+            for state in [self.state(entry)]
+            if entry.id not in self.running and state['next_run'] <= time.time()
+        )
+        for _, _, entry in due[:self.max_syncs - len(self.running)]:
+            print_status(f'Starting scheduled sync of {entry.name}')
+            self.running[entry.id] = pool.submit(self.engine.sync, entry.name)
+
+    def run(self):
+        if not self.entries():
+            return Left(Issue('no entry has an interval to schedule'))
+        with ThreadPoolExecutor(max_workers=self.max_syncs) as pool:
+            try:
+                while True:
+                    self.tick(pool)
+                    time.sleep(SCHEDULE_TICK)
+            except KeyboardInterrupt:
+                print_status('Waiting for the running syncs to finish...')
+        self.collect(wait=True)
+        return Right(True)
+
+
+def schedule(names, max_syncs):
+    options = OPTIONS.get()
+    output = threading.Lock()
+
+    def on_event(name, event):
+        # Lines of concurrent syncs are told apart by the entry name
+        with output:
+            print(f'[{name}] {render(event)}', flush=True)
+    return eval_iteration(lambda: [
+        True
+        for engine in [SyncEngine(
+            on_event=on_event,
+            seed_compressor=options.seed_compressor,
+            max_transfers=options.max_transfers,
+            workers=max_syncs,
+        )]
+        for _ in sequence(get_entry(engine.entries, name) for name in names)
+        for _ in Scheduler(engine, names, max_syncs).run()
+    ])
+
+
 def parse_args():
     usage = inspect.cleandoc("""
         %prog local remote name
@@ -685,6 +3819,38 @@ def parse_args():
         dest='new_name',
         default=None, metavar='NAME',
         help='Modify NAME of entry (Requires one arg [current name])')
+    parser.add_option('-a', '--add-replica',
+        dest='replica',
+        default=None, metavar='REMOTE',
+        help='Add another remote directory to an entry (Requires one arg [name])')
+    parser.add_option('--plan',
+        dest='plan',
+        action="store_true",
+        default=False,
+        help='Print what a sync of the entry would transfer and delete '
+             'without changing anything (Requires one arg [name])')
+    parser.add_option('--verify',
+        dest='verify',
+        action="store_true",
+        default=False,
+        help='Compare the content hashes of every file on both sides and '
+             'report the files that differ (Requires one arg [name])')
+    parser.add_option('--changes',
+        dest='cursor',
+        type='int', default=None, metavar='CURSOR',
+        help='Print the changes made by the syncs of an entry as JSON lines, '
+             'starting at CURSOR (0 for all of them; Requires one arg [name])')
+    parser.add_option('--schedule',
+        dest='schedule',
+        action="store_true",
+        default=False,
+        help='Keep running and sync the entries which have an interval '
+             '(optionally only the given names)')
+    parser.add_option('--max-syncs',
+        dest='max_syncs',
+        type='int', default=MAX_SYNCS, metavar='NUM',
+        help='Maximum number of entries synced at the same time by '
+             '--schedule (default %d)' % MAX_SYNCS)
     parser.add_option('--no-color',
         dest='no_color',
         action="store_true",
@@ -695,6 +3861,17 @@ def parse_args():
         action="store_true",
         default=False,
         help='Skips confirmation prompt (for batch jobs)')
+    parser.add_option('--seed-compress',
+        dest='seed_compress',
+        type='choice', choices=list(SEED_COMPRESSORS),
+        default=None, metavar='PROG',
+        help='Compress the tar stream used to seed an empty directory on '
+             'the first sync of an entry (%s)' % ', '.join(SEED_COMPRESSORS))
+    parser.add_option('--max-transfers',
+        dest='max_transfers',
+        type='int', default=None, metavar='NUM',
+        help='Maximum number of transfers running at the same time across '
+             'all pysync processes on this machine')
     parser.add_option('-l',
         dest='list_entries',
         action="store_true",
@@ -708,32 +3885,31 @@ def handle(either, err_msg):
 
 
 def main():
-    global COLORS, ANSWER_YES
     pysync_dir = f'{os.environ["HOME"]}/.pysync'
     if not os.path.isdir(pysync_dir):
         os.makedirs(pysync_dir)
 
     (options, args) = parse_args()
-    if options.no_color:
-        COLORS = False
+    OPTIONS.set(Options(
+        colors=not options.no_color,
+        answer_yes=options.answer_yes,
+        seed_compressor=options.seed_compress,
+        max_transfers=options.max_transfers,
+    ))
 
-    if options.answer_yes:
-        ANSWER_YES = True
+    if options.schedule:
+        result = load_entries().flat_map(lambda _: schedule(args, options.max_syncs))
+        return handle(result, 'Unable to run the scheduler.')
 
     if len(args) > 3:
         return error(f'{PROG} takes at most 3 arguments. See {PROG} -h')
     if len(args) == 2:
         return error(f'Provide an alias for the entry. See {PROG} -h')
 
-    entries = []
-    if os.path.isfile(SETTINGS):
-        result = read_json(SETTINGS)
-        if not result.right:
-            return error('Unable to read entries', result.value)
-        entries = [
-            Pair(x['name'], x['local'], x['remote'], x['date_created'], x['date_synced'])
-            for x in result.value
-        ]
+    result = load_entries()
+    if not result.right:
+        return error('Unable to read entries', result.value)
+    entries = result.value
 
     if len(args) == 3:
         result = register(entries, args[0], args[1], args[2])
@@ -752,6 +3928,31 @@ def main():
         result = reset_sync_date(entries, options.reset_num)
         return handle(result, 'Unable to reset the entry.')
 
+    if options.plan:
+        if len(args) != 1:
+            return error(f'Usage: {PROG} --plan name')
+        OPTIONS.get().status_file = sys.stderr
+        result = plan(entries, args[0])
+        return handle(result, 'Unable to plan the sync.')
+
+    if options.cursor is not None:
+        if len(args) != 1:
+            return error(f'Usage: {PROG} --changes cursor name')
+        result = print_changes(entries, args[0], options.cursor)
+        return handle(result, 'Unable to read the changes.')
+
+    if options.verify:
+        if len(args) != 1:
+            return error(f'Usage: {PROG} --verify name')
+        result = verify(entries, args[0])
+        return handle(result, 'Verification failed.')
+
+    if options.replica:
+        if len(args) != 1:
+            return error(f'Usage: {PROG} -a [remote] name')
+        result = add_replica(entries, options.replica, args[0])
+        return handle(result, 'Unable to add replica.')
+
     if options.new_name:
         if len(args) != 1:
             return error(f'Usage: {PROG} -n [new_name] current_name')